@@ -0,0 +1,228 @@
+import java.io.*;
+import java.lang.management.ManagementFactory;
+import java.lang.management.ThreadMXBean;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.URL;
+import java.net.URLClassLoader;
+import javax.tools.JavaCompiler;
+import javax.tools.ToolProvider;
+
+/**
+ * Long-lived harness used by grade.py --jvm-runner. Runs a program's main()
+ * in a fresh class loader, and compiles with the in-process javac, so the
+ * JVM only starts once per grading process.
+ *
+ * Requests arrive on stdin, one per line:
+ *   RUN \t classPath \t className \t maxOutput \t inputLength \n  input bytes
+ *   COMPILE \t dir \t sourceFile \t classPath \n
+ * where classPath is directories separated by File.pathSeparator.
+ * and each is answered on stdout with:
+ *   DONE \t status \t outLength \t errLength \t cpuMillis \t truncated \n  out bytes  err bytes
+ * A COMPILE status of -1 means this JVM has no system compiler (a JRE).
+ */
+public class GradeRunner {
+
+    /** Thrown in place of System.exit() so the harness survives it. */
+    static class ExitException extends SecurityException {
+        final int status;
+        ExitException(int status) {
+            super("System.exit(" + status + ")");
+            this.status = status;
+        }
+    }
+
+    /** Thrown from a capture stream once the program exceeds its budget. */
+    static class OutputLimitError extends Error {
+    }
+
+    static class CaptureStream extends ByteArrayOutputStream {
+        final int limit;
+        boolean truncated;
+
+        CaptureStream(int limit) {
+            this.limit = limit;
+        }
+
+        @Override
+        public synchronized void write(int b) {
+            write(new byte[] {(byte) b}, 0, 1);
+        }
+
+        @Override
+        public synchronized void write(byte[] b, int off, int len) {
+            if (count + len > limit) {
+                super.write(b, off, Math.max(limit - count, 0));
+                truncated = true;
+                throw new OutputLimitError();
+            }
+            super.write(b, off, len);
+        }
+    }
+
+    static boolean trapExit() {
+        try {
+            System.setSecurityManager(new SecurityManager() {
+                @Override
+                public void checkExit(int status) {
+                    throw new ExitException(status);
+                }
+
+                @Override
+                public void checkPermission(java.security.Permission perm) {
+                }
+            });
+            return true;
+        } catch (UnsupportedOperationException e) {
+            // Java 18+ without -Djava.security.manager=allow: System.exit()
+            // ends the harness and grade.py reruns that test in a plain JVM.
+            return false;
+        }
+    }
+
+    /** Swallows everything, for System.out/err between runs. */
+    static class NullStream extends OutputStream {
+        @Override
+        public void write(int b) {
+        }
+
+        @Override
+        public void write(byte[] b, int off, int len) {
+        }
+    }
+
+    public static void main(String[] args) throws IOException {
+        InputStream in = new BufferedInputStream(new FileInputStream(FileDescriptor.in));
+        OutputStream out = new BufferedOutputStream(new FileOutputStream(FileDescriptor.out));
+        // replies go to `out` only; threads a program leaves running after
+        // main() returns must not write into them through System.out
+        PrintStream discard = new PrintStream(new NullStream());
+        System.setOut(discard);
+        System.setErr(discard);
+        trapExit();
+        String line;
+        while ((line = readLine(in)) != null) {
+            String[] request = line.split("\t");
+            if (request[0].equals("RUN") && request.length == 5) {
+                byte[] input = new byte[Integer.parseInt(request[4])];
+                new DataInputStream(in).readFully(input);
+                run(request[1], request[2], Integer.parseInt(request[3]), input, out);
+            } else if (request[0].equals("COMPILE") && request.length == 4) {
+                compile(request[1], request[2], request[3], out);
+            } else {
+                throw new IOException("bad request: " + line);
+            }
+        }
+    }
+
+    /** Same as `javac -nowarn -cp classPath sourceFile` run inside dir. */
+    static void compile(String dir, String source, String classPath, OutputStream reply)
+            throws IOException {
+        ByteArrayOutputStream stdout = new ByteArrayOutputStream();
+        ByteArrayOutputStream stderr = new ByteArrayOutputStream();
+        JavaCompiler javac = ToolProvider.getSystemJavaCompiler();
+        int status = -1;
+        if (javac != null) {
+            status = javac.run(null, stdout, stderr, "-nowarn", "-d", dir, "-cp", classPath,
+                               new File(dir, source).getPath());
+        }
+        reply(reply, status, stdout.toByteArray(), stderr.toByteArray(), 0, false);
+    }
+
+    static void run(String classPath, final String className, int maxOutput,
+                    byte[] input, OutputStream reply) throws IOException {
+        final CaptureStream stdout = new CaptureStream(maxOutput);
+        final CaptureStream stderr = new CaptureStream(maxOutput);
+        final PrintStream err = new PrintStream(stderr, true);
+        final int[] status = {0};
+        final long[] cpu = {0};
+        PrintStream savedOut = System.out;
+        PrintStream savedErr = System.err;
+        InputStream savedIn = System.in;
+
+        // parent is the platform loader, so nothing from the last run is shared
+        String[] dirs = classPath.split(File.pathSeparator);
+        URL[] urls = new URL[dirs.length];
+        for (int i = 0; i < dirs.length; i++) {
+            urls[i] = new File(dirs[i]).toURI().toURL();
+        }
+        final URLClassLoader loader = new URLClassLoader(
+                urls, ClassLoader.getSystemClassLoader().getParent());
+        Thread main = new Thread("main") {
+            @Override
+            public void run() {
+                ThreadMXBean mx = ManagementFactory.getThreadMXBean();
+                try {
+                    Class<?> cls = Class.forName(className, true, loader);
+                    Method m = cls.getMethod("main", String[].class);
+                    m.invoke(null, (Object) new String[0]);
+                } catch (InvocationTargetException e) {
+                    status[0] = failed(e.getCause(), err);
+                } catch (Throwable e) {
+                    status[0] = failed(e, err);
+                } finally {
+                    cpu[0] = mx.isCurrentThreadCpuTimeSupported()
+                            ? mx.getCurrentThreadCpuTime() / 1000000 : 0;
+                }
+            }
+        };
+        main.setContextClassLoader(loader);
+        System.setIn(new ByteArrayInputStream(input));
+        System.setOut(new PrintStream(stdout, true));
+        System.setErr(err);
+        try {
+            main.start();
+            main.join();
+        } catch (InterruptedException e) {
+            status[0] = 1;
+        } finally {
+            System.out.flush();
+            System.setIn(savedIn);
+            System.setOut(savedOut);
+            System.setErr(savedErr);
+            loader.close();
+        }
+
+        reply(reply, status[0], stdout.toByteArray(), stderr.toByteArray(), cpu[0],
+              stdout.truncated || stderr.truncated);
+    }
+
+    static void reply(OutputStream reply, int status, byte[] out, byte[] err,
+                      long cpuMillis, boolean truncated) throws IOException {
+        String header = "DONE\t" + status + "\t" + out.length + "\t" + err.length
+                + "\t" + cpuMillis + "\t" + (truncated ? 1 : 0) + "\n";
+        reply.write(header.getBytes("UTF-8"));
+        reply.write(out);
+        reply.write(err);
+        reply.flush();
+    }
+
+    /** Reports an uncaught throwable the way the java launcher does. */
+    static int failed(Throwable t, PrintStream err) {
+        if (t instanceof ExitException) {
+            return ((ExitException) t).status;
+        }
+        if (t instanceof OutputLimitError) {
+            return 1;
+        }
+        try {
+            err.print("Exception in thread \"main\" ");
+            t.printStackTrace(err);
+        } catch (OutputLimitError e) {
+            // stderr budget used up as well
+        }
+        return 1;
+    }
+
+    static String readLine(InputStream in) throws IOException {
+        ByteArrayOutputStream line = new ByteArrayOutputStream();
+        int b;
+        while ((b = in.read()) != '\n') {
+            if (b < 0) {
+                return line.size() == 0 ? null : line.toString("UTF-8");
+            }
+            line.write(b);
+        }
+        return line.toString("UTF-8");
+    }
+}
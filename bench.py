@@ -0,0 +1,290 @@
+import argparse
+import csv
+import logging
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+import grade
+import quiz
+from roster import Roster
+
+# Throughput benchmark for grade.py and quiz.py on a synthetic class.
+#
+# Builds a turnin folder of N submissions named like Canvas does, a Canvas
+# CSV, a rubric and test inputs, and puts stub javac/java executables first
+# on the PATH so it runs on any box without a JDK. The stubs take their
+# timing from the environment (BENCH_*), and each submission's behaviour
+# from a '// BENCH: <kind>' marker in its source.
+
+# set up command-line arguments
+FLAGS = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+A = FLAGS.add_argument
+A('-n', '--sizes', default=[10, 100, 1000, 5000], nargs='+', type=int, metavar='N',
+                    help='Class sizes to benchmark')
+A('--sample', default=40, type=int, metavar='N',
+                    help='Submissions to run through runStudent/diff at each size')
+A('--lookups', default=1000, type=int, metavar='N',
+                    help='Mistyped EIDs looked up through quiz.vagueSearch')
+A('--mix', default='ok=0.6,wrong=0.3,error=0.05,loop=0.05', metavar='KIND=P,...',
+                    help='Share of ok/wrong/error/slow/loop submissions')
+A('--compile-time', default=0.05, type=float, metavar='SECONDS', help='Time the stub javac takes')
+A('--output-lines', default=20, type=int, metavar='N', help='Lines the stub program prints per input line')
+A('--read-delay', default=0.0, type=float, metavar='SECONDS',
+                    help='Time the stub program computes before each read (x10 for slow submissions)')
+A('--dir', metavar='DIR', help='Build the corpus here instead of a temporary folder')
+A('--keep', default=False, action='store_true', help='Keep the corpus afterwards')
+A('--seed', default=312, type=int, help='Random seed for the corpus')
+
+KINDS = ['ok', 'wrong', 'error', 'slow', 'loop']
+
+STUB_JAVAC = r'''#!%(python)s
+# javac stand-in: 'compiles' Foo.java into Foo.class by copying it
+import os, sys, time
+argv = sys.argv[1:]
+dest = None
+if '-d' in argv:
+    dest = argv[argv.index('-d') + 1]
+source = argv[-1]
+time.sleep(float(os.environ.get('BENCH_COMPILE_TIME', '0')))
+text = open(source).read()
+if 'BENCH: error' in text:
+    sys.stderr.write('%%s:1: error: cannot find symbol\n1 error\n' %% source)
+    sys.exit(1)
+target = os.path.basename(source)[:-5] + '.class'
+target = os.path.join(dest or os.path.dirname(source), target)
+open(target, 'w').write(text)
+'''
+
+STUB_JAVA = r'''#!%(python)s
+# java stand-in: echoes each input line output-lines times until 'quit'
+import os, sys, time
+classname = [a for a in sys.argv[1:] if not a.startswith('-')][-1]
+text = open(classname + '.class').read()
+lines = int(os.environ.get('BENCH_OUTPUT_LINES', '20'))
+delay = float(os.environ.get('BENCH_READ_DELAY', '0'))
+if 'BENCH: loop' in text:
+    while True:
+        pass
+if 'BENCH: slow' in text:
+    delay = delay * 10
+n = 0
+while True:
+    sys.stdout.write('Enter a line: ')
+    sys.stdout.flush()
+    time.sleep(delay)
+    line = sys.stdin.readline()
+    if not line or line.strip() == 'quit':
+        break
+    n += 1
+    for i in range(lines):
+        word = line.strip()
+        if 'BENCH: wrong' in text and i %% 7 == 3:
+            word = word.upper()
+        sys.stdout.write('%%d.%%d %%s\n' %% (n, i, word))
+sys.stdout.write('Read %%d line(s)\n' %% n)
+'''
+
+FIRST = ['Ana', 'Ben', 'Chen', 'Dara', 'Eli', 'Fatima', 'Gus', 'Hana', 'Ivan', 'Jo',
+         'Kemal', 'Lena', 'Mateo', 'Nia', 'Omar', 'Priya', 'Quinn', 'Rosa', 'Sven', 'Tara']
+LAST = ['Garcia', 'Smith', 'Nguyen', 'Patel', 'Kim', 'Lopez', 'Brown', 'Chen', 'Okafor',
+        'Rossi', 'Silva', 'Novak', 'Haddad', 'Tanaka', 'Murphy', 'Singh', 'Cohen', 'Berg']
+
+
+# write an executable script
+def writeStub(path, text):
+    with open(path, 'w') as f:
+        f.write(text % {'python': sys.executable})
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+def makeStubs(binDir, args):
+    if not os.path.exists(binDir):
+        os.makedirs(binDir)
+    writeStub(os.path.join(binDir, 'javac'), STUB_JAVAC)
+    writeStub(os.path.join(binDir, 'java'), STUB_JAVA)
+    os.environ['PATH'] = binDir + os.pathsep + os.environ['PATH']
+    os.environ['BENCH_COMPILE_TIME'] = str(args.compile_time)
+    os.environ['BENCH_OUTPUT_LINES'] = str(args.output_lines)
+    os.environ['BENCH_READ_DELAY'] = str(args.read_delay)
+
+# 'ok=0.6,wrong=0.4' -> [('ok', 0.6), ('wrong', 0.4)]
+def parseMix(mix):
+    shares = []
+    for item in mix.split(','):
+        kind, share = item.split('=')
+        assert kind in KINDS, 'unknown submission kind %s' % kind
+        shares.append((kind, float(share)))
+    return shares
+
+def pickKind(rand, shares):
+    x = rand.random() * sum(share for kind, share in shares)
+    for kind, share in shares:
+        x -= share
+        if x < 0:
+            return kind
+    return shares[-1][0]
+
+# A class of n students in root: turnin/, info.csv, rubric.txt, support/
+# with the test inputs, and the solution Song.java. Returns the students
+# as (cid, eid, name) tuples.
+def makeCorpus(root, n, args):
+    rand = random.Random(args.seed)
+    shares = parseMix(args.mix)
+    for folder in ('turnin', 'support'):
+        os.makedirs(os.path.join(root, folder))
+    with open(os.path.join(root, 'Song.java'), 'w') as f:
+        f.write('public class Song {}\n')
+    for i, words in enumerate([['la', 'di', 'da'], ['twinkle', 'little', 'star', 'how', 'I', 'wonder']]):
+        with open(os.path.join(root, 'support', 'in%d.txt' % (i + 1)), 'w') as f:
+            f.write('\n'.join(words) + '\nquit\n')
+    with open(os.path.join(root, 'rubric.txt'), 'w') as f:
+        f.write('correctness\n10|passes tests|output correct\nstyle\n5|naming|naming\n-3|no header|missing header\n')
+
+    students = []
+    rows = [['Student', 'ID', 'SIS User ID', 'SIS Login ID', 'Section',
+             'Assignment 1 (1001) ', 'Slip Days (1)', 'Quiz 1 (2001)'],
+            ['    Points Possible', '', '', '', '', '20', '', '10']]
+    for i in xrange(n):
+        first, last = rand.choice(FIRST), rand.choice(LAST)
+        cid = str(100000 + i)
+        eid = '%s%s%d' % (first[0].lower(), last[0].lower(), rand.randint(100, 99999))
+        students.append((cid, eid, '%s, %s' % (last, first)))
+        rows.append(['%s, %s' % (last, first), cid, eid, eid,
+                     'CS312 (%d)' % (50000 + i % 8), '', '0', ''])
+        kind = pickKind(rand, shares)
+        name = '%s--%s_%s_%d_Song.java' % (last.lower(), first.lower(), cid, 200000 + i)
+        with open(os.path.join(root, 'turnin', name), 'w') as f:
+            f.write('// BENCH: %s\npublic class Song {}\n' % kind)
+    with open(os.path.join(root, 'info.csv'), 'wb') as f:
+        csv.writer(f).writerows(rows)
+    return students
+
+# grade.py's arguments for the corpus
+def gradeArgs():
+    args = grade.FLAGS.parse_args(['-a', '1', '-c', 'bench', '-g', 'Bench', '-s', 'Song.java',
+                                   '-t', 'turnin', '-i', 'in1.txt', 'in2.txt', '-n', 'info.csv',
+                                   '-r', 'rubric.txt', '-f', 'support', '-p', '0', '--cpu-limit', '1'])
+    args.golden = None
+    return args
+
+# (seconds, result of fn)
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+# swallow grade.py's chatter while fn runs
+def quietly(fn, *args):
+    saved = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return fn(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved
+
+# one character changed, dropped or added
+def typo(rand, word):
+    i = rand.randrange(len(word))
+    edit = rand.choice(['change', 'drop', 'add'])
+    if edit == 'change':
+        return word[:i] + rand.choice('abcdefghijklmnopqrstuvwxyz0123456789') + word[i + 1:]
+    if edit == 'drop':
+        return word[:i] + word[i + 1:]
+    return word[:i] + rand.choice('abcdefghijklmnopqrstuvwxyz') + word[i:]
+
+# Time every stage at class size n in root. Returns rows of
+# (stage, count, seconds).
+def benchSize(root, n, args):
+    results = []
+    students = makeCorpus(root, n, args)
+    os.chdir(root)
+    gargs = gradeArgs()
+    grade.configure(gargs, root)
+
+    gargs.refresh_golden = True
+    seconds, solutions = timed(quietly, grade.genGolden, gargs)
+    results.append(('genGolden', 1, seconds))
+    os.chdir(root)
+    gargs.refresh_golden = False
+    seconds, solutions = timed(quietly, grade.genGolden, gargs)
+    results.append(('genGolden cached', 1, seconds))
+    os.chdir(root)
+
+    sample = sorted(os.listdir('turnin'))[:args.sample]
+    outputs = []
+    for label in ('runStudent', 'runStudent cached'):
+        total = 0.0
+        for filename in sample:
+            seconds, ok = timed(quietly, grade.testStudent, gargs, root,
+                                grade.re.match(grade.FPATTERN, filename), solutions)
+            os.chdir(root)
+            total += seconds
+            outputs.extend(test['outFile'] for test in ok['tests'] if test.get('outFile'))
+        results.append((label, len(sample), total))
+
+    total = 0.0
+    for path in outputs[:args.sample]:
+        with open(path) as f:
+            student = f.read()
+        seconds, html = timed(grade.diff, solutions[0][0], student)
+        total += seconds
+    results.append(('diff', min(len(outputs), args.sample), total))
+
+    rand = random.Random(args.seed)
+    scores = dict((cid, rand.randint(0, 20)) for cid, eid, name in students)
+    slips = dict((cid, rand.randint(0, 2)) for cid, eid, name in students)
+    shutil.copy('info.csv', '.info.csv')
+    seconds, _ = timed(quietly, grade.update_grades, 'info.csv', scores, slips, 1)
+    results.append(('update_grades', n, seconds))
+
+    roster = Roster.load('info.csv')
+    names = dict(zip(roster.cids, roster.names))
+    eids = dict(zip(roster.eids, roster.cids))
+    seconds, finder = timed(quiz.FuzzyIndex, eids, names)
+    results.append(('FuzzyIndex', n, seconds))
+    queries = [typo(rand, rand.choice(students)[1]) for i in xrange(args.lookups)]
+    start = time.time()
+    for query in queries:
+        quiz.vagueSearch(finder, query)
+    results.append(('vagueSearch', len(queries), time.time() - start))
+    column = roster.column('Quiz 1', default=8)
+    qargs = argparse.Namespace(info='info.csv')
+    seconds, _ = timed(quiz.write, scores, roster, column, qargs)
+    results.append(('quiz write', n, seconds))
+    return results
+
+def report(n, results):
+    print "%d students" % n
+    print "  %-18s %7s %10s %12s" % ('stage', 'count', 'total s', 'per item ms')
+    for stage, count, seconds in results:
+        print "  %-18s %7d %10.3f %12.3f" % (stage, count, seconds, seconds / max(count, 1) * 1000)
+    print
+
+def main(args):
+    logging.disable(logging.ERROR)
+    top = os.path.abspath(args.dir) if args.dir else tempfile.mkdtemp(prefix='gradebench-')
+    startDir = os.getcwd()
+    try:
+        makeStubs(os.path.join(top, 'bin'), args)
+        for n in args.sizes:
+            root = os.path.join(top, 'class-%d' % n)
+            if os.path.exists(root):
+                shutil.rmtree(root)
+            os.makedirs(root)
+            report(n, benchSize(root, n, args))
+            os.chdir(startDir)
+    finally:
+        os.chdir(startDir)
+        if args.keep:
+            print "Corpus kept in %s" % top
+        else:
+            shutil.rmtree(top, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(FLAGS.parse_args())
@@ -1,32 +1,62 @@
 import argparse
 import contextlib
 import csv
-import difflib
+import functools
+import cgi
 import logging
 import os
 import re
+import resource
 import shutil
+import sqlite3
 import subprocess
 import sys
 import tempfile
 import threading
 import multiprocessing
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import BytesIO as StringIO
 try:
     from Queue import Queue, Empty
 except ImportError:
     from queue import Queue, Empty
+try:
+    import BaseHTTPServer
+    from urlparse import urlparse, parse_qs
+    from urllib import quote, unquote
+except ImportError:
+    import http.server as BaseHTTPServer
+    from urllib.parse import urlparse, parse_qs, quote, unquote
 from subprocess import PIPE, Popen
 from threading  import Thread
 import select
+import array
+import termios
+import signal
 import time
 import  fcntl
 import errno
+import hashlib
+import json
 import webbrowser
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+
+from roster import Roster
+import staging
 
 # set up command-line arguments
 FLAGS = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 A = FLAGS.add_argument
+A('mode', nargs='?', default='grade', choices=['grade', 'autograde', 'rescore', 'serve'],
+                    help='grade interactively, autograde every submission without prompts, '
+                         'rescore the gradebook with the current rubric weights, '
+                         'or serve diffs of the saved outputs on localhost')
 A('-a', '--assignment', type=int, help='Assignment Number')
 A('-c', '--cslogin', type=str, help='CS login of grader')
 A('-f', '--folder', metavar='DIR', help='Folder with all required files')
@@ -39,6 +69,48 @@ A('-r', '--rubric', metavar='FILE', help='txt file cotaining the grading rubric'
 A('-s', '--solution', default='Song.java', metavar='FILE', help='instructor solution')
 A('-t', '--turnin', default='turnin', metavar='DIR', help='turnin folder with .java file')
 A('-w', '--webbrowser', default=False, type=bool, help='Open diff result in webbrowser if True')
+A('--max-output', default=1 << 20, type=int, metavar='BYTES',
+                    help='Keep at most this many bytes of stdout/stderr per run')
+A('--pacing', default='prompt', choices=['prompt', 'fixed'],
+                    help='Feed each input line once the program reads stdin, or after 0.5s of quiet')
+A('--jvm-runner', default=False, action='store_true',
+                    help='Run tests in one long-lived JVM per process instead of a new java each time')
+A('--precompile', default=False, action='store_true',
+                    help='Compile every submission before grading and set aside compile errors')
+A('--refresh-golden', default=False, action='store_true',
+                    help='Rerun the instructor solution even if its cached outputs are current')
+A('--golden-timeout', default=300, type=int, metavar='SECONDS',
+                    help='Wall-clock limit for each test of the instructor solution')
+A('--budget-factor', default=5.0, type=float, metavar='K',
+                    help='Stop a test after K times the instructor solution\'s run time plus --budget-slack')
+A('--budget-slack', default=1.0, type=float, metavar='SECONDS',
+                    help='Seconds added to every test\'s time budget, for JVM start and timer noise')
+A('--slow-factor', default=2.0, type=float, metavar='K',
+                    help='Flag correct tests that take more than K times the instructor solution\'s time. '
+                         'Only runs that finish within the budget can be flagged: raise --budget-factor '
+                         '(e.g. 100 with --slow-factor 10) to report runs orders of magnitude slower')
+A('--cpu-limit', default=10, type=int, metavar='SECONDS',
+                    help='CPU seconds for each test run (0 for no limit)')
+A('--mem-limit', default=0, type=int, metavar='MB',
+                    help='Address space for each test run (0 for no limit; the JVM reserves much more than it uses, see --xmx)')
+A('--nproc-limit', default=0, type=int, metavar='N',
+                    help='Processes/threads of the grading user while a test runs (0 for no limit)')
+A('--fsize-limit', default=64, type=int, metavar='MB',
+                    help='Largest file a test run may write (0 for no limit)')
+A('--xmx', default='512m', metavar='SIZE',
+                    help='Java heap limit for test runs (empty for the JVM default)')
+A('--profile', metavar='FILE',
+                    help='Record timing spans to FILE (JSON lines) and FILE.trace.json (Chrome trace)')
+A('--cluster', default=False, action='store_true',
+                    help='Run every submission first, then grade submissions with the same test results together, offering the correctness score given to the first for the rest')
+A('--port', default=8312, type=int, help='Port for serve')
+A('-j', '--jobs', default=multiprocessing.cpu_count(), type=int,
+                    help='Worker processes for autograde')
+A('-p', '--prefetch', default=2, type=int, metavar='N',
+                    help='Compile/run/diff the next N submissions in the background (0 to disable)')
+
+#             lastN    firstN   cId     fid     fName
+FPATTERN = r'([\w-]*)--([\w-]*)_([\d]*)_([\d]*)_([\w]*.java)'
 
 
 
@@ -55,92 +127,874 @@ class TimeOutError(Error):
     def __init__(self, time):
         self.time = time
 
-# Execute a command, uses blocking        
+TRUNCATED = '\n*** output truncated after %d bytes ***\n'
+
+# --profile: timing spans as one JSON object per line, appended to by the
+# grading process and its workers alike
+class Profile(object):
+    path = None         # None when --profile is off
+    tags = {}           # added to every span of this process, e.g. the cid
+    fd = None
+    fdPid = None
+
+    @classmethod
+    def start(cls, path):
+        cls.path = os.path.abspath(path)
+        open(cls.path, 'w').close()
+
+    @classmethod
+    def record(cls, name, start, duration, tags):
+        if cls.fd is None or cls.fdPid != os.getpid():
+            cls.fd = os.open(cls.path, os.O_WRONLY | os.O_APPEND)
+            cls.fdPid = os.getpid()
+        span = dict(cls.tags)
+        span.update(tags)
+        span.update(name=name, start=start, dur=duration, pid=os.getpid())
+        # one write per line; O_APPEND keeps lines from different processes whole
+        os.write(cls.fd, json.dumps(span) + '\n')
+
+    @classmethod
+    def load(cls):
+        with open(cls.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    # write the Chrome trace and print where the time went
+    @classmethod
+    def report(cls):
+        if cls.path is None:
+            return
+        spans = cls.load()
+        if not spans:
+            return
+        events = []
+        for span in spans:
+            tags = dict((k, v) for k, v in span.items() if k not in ('name', 'start', 'dur', 'pid'))
+            events.append({'name': span['name'], 'ph': 'X', 'pid': span['pid'], 'tid': span['pid'],
+                           'ts': int(span['start'] * 1e6), 'dur': int(span['dur'] * 1e6), 'args': tags})
+        with open(cls.path + '.trace.json', 'w') as f:
+            json.dump({'traceEvents': events}, f)
+
+        wall = max(s['start'] + s['dur'] for s in spans) - min(s['start'] for s in spans)
+        totals = defaultdict(list)
+        for span in spans:
+            totals[span['name']].append(span['dur'])
+        print "%-14s %7s %10s %10s %10s %7s" % ('span', 'count', 'total s', 'mean ms', 'max ms', 'wall %')
+        for name, durs in sorted(totals.items(), key=lambda item: -sum(item[1])):
+            print "%-14s %7d %10.2f %10.1f %10.1f %6.1f%%" % (name, len(durs), sum(durs),
+                sum(durs) / len(durs) * 1000, max(durs) * 1000, sum(durs) / max(wall, 1e-9) * 100)
+        print "Spans in '%s', Chrome trace in '%s.trace.json' (%.1fs wall)" % (cls.path, cls.path, wall)
+
+# Time the with block as a span called name when --profile is on. Yields the
+# span's tags so the block can add to them.
+@contextlib.contextmanager
+def span(name, **tags):
+    if Profile.path is None:
+        yield tags
+        return
+    start = time.time()
+    try:
+        yield tags
+    finally:
+        Profile.record(name, start, time.time() - start, tags)
+
+# raw_input, timed as a 'prompt' span
+def ask(prompt):
+    with span('prompt'):
+        return raw_input(prompt)
+
+# read(2)/readv(2) syscall numbers, as shown in /proc/<pid>/task/<tid>/syscall
+READ_SYSCALLS = {
+    'x86_64': ('0', '19'),
+    'i386': ('3', '145'), 'i686': ('3', '145'),
+    'aarch64': ('63', '65'),
+    'armv7l': ('3', '145'),
+}
+
+# Program output collected as a list of chunks, moved to the file spillPath
+# once it grows past SPILL bytes so a chatty program doesn't sit in memory.
+# path is None until it has spilled.
+class OutputBuffer(object):
+    SPILL = 256 << 10
+
+    def __init__(self, spillPath=None):
+        self.spillPath = spillPath
+        self.path = None
+        self.file = None
+        self.chunks = []
+        self.size = 0
+
+    @classmethod
+    def of(cls, text):
+        buf = cls()
+        buf.write(text)
+        return buf
+
+    # the output saved in path by an earlier run
+    @classmethod
+    def saved(cls, path):
+        buf = cls(path)
+        buf.path = path
+        buf.size = os.path.getsize(path)
+        return buf
+
+    def __len__(self):
+        return self.size
+
+    def write(self, s):
+        self.size += len(s)
+        if self.path is None:
+            self.chunks.append(s)
+            if self.spillPath is None or self.size <= self.SPILL:
+                return
+            self.path = self.spillPath
+            self.file = open(self.path, 'wb')
+            s = ''.join(self.chunks)
+            self.chunks = []
+        elif self.file is None:
+            self.file = open(self.path, 'ab')
+        self.file.write(s)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def getvalue(self):
+        if self.path is None:
+            return ''.join(self.chunks)
+        self.close()
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    # the lines without their line breaks, streamed from the file once
+    # spilled. Split on '\n' only either way (not splitlines(), which also
+    # breaks at '\r', '\f', ...) so a saved output hashes like the string.
+    def lines(self):
+        if self.path is None:
+            f = StringIO(self.getvalue())
+        else:
+            self.close()
+            f = open(self.path, 'rb')
+        with contextlib.closing(f):
+            for line in f:
+                yield line.rstrip('\r\n')
+
+    # move the output to spillPath even if it is small, so it outlives the run
+    def save(self):
+        if self.path is None and self.spillPath is not None:
+            self.path = self.spillPath
+            with open(self.path, 'wb') as f:
+                f.writelines(self.chunks)
+            self.chunks = []
+
+    # for the diff worker: a spilled buffer goes over as its path
+    def __getstate__(self):
+        self.close()
+        return self.__dict__
+
+
+# Execute a command, feeding it input one line at a time. The command gets
+# its own process group so a timeout kills everything it started.
 class Command(object):
+    PACE = 0.5              # seconds of quiet before the next input line
+    POLL = 0.005            # first check whether the program wants input, backs
+    MAX_POLL = 0.1          # off up to MAX_POLL while it is busy computing
+    maxOutput = 1 << 20     # byte budget for each of stdout and stderr
+    pacing = 'prompt'       # 'prompt': write once the program reads stdin, 'fixed': PACE
+    limits = []             # (resource, soft, hard) for limited commands, see rlimits()
+    xmx = None              # java -Xmx for test runs
+
     # Input is a string of lines seperated by '/n'
     # Each line is passsed to the program sequentially
-    def __init__(self, args, input):
+    # limited - apply Command.limits to the program (student code)
+    # spill - path prefix for stdout/stderr that outgrow OutputBuffer.SPILL
+    def __init__(self, args, input, limited=False, spill=None):
         self.args = args
         self.input = input.splitlines(True)
-        self.out = ""
-        self.err = ""
-    
+        self.limited = limited
+        self.usage = None   # (user, sys, max RSS KB) once the program is reaped
+        self.out = OutputBuffer(spill and spill + '.stdout')
+        self.err = OutputBuffer(spill and spill + '.stderr')
+        self.truncated = False
+        self.timedOut = False
+        self.reader = None
+        self.status = None
+        self.elapsed = 0.0
+        self.paced = 0.0    # program idle between its last output and the next input line
+
+    # keep at most maxOutput bytes of each stream
+    def capture(self, name, s):
+        buf = getattr(self, name)
+        room = self.maxOutput - buf.size
+        if len(s) > room:
+            s = s[:max(room, 0)] + TRUNCATED % self.maxOutput
+            self.truncated = True
+        buf.write(s)
+
+    # True if some thread of the program is blocked reading its (empty) stdin,
+    # None if /proc can't tell us and we have to fall back to fixed pacing.
+    def waitingForInput(self, p):
+        reads = READ_SYSCALLS.get(os.uname()[4])
+        if reads is None:
+            return None
+        buf = array.array('i', [0])
+        fcntl.ioctl(p.stdin.fileno(), termios.FIONREAD, buf, True)
+        if buf[0] > 0:
+            return False
+        taskDir = '/proc/%d/task' % p.pid
+        try:
+            tids = os.listdir(taskDir)
+            # the thread we last saw reading is the one most likely to be again
+            if self.reader in tids:
+                tids.remove(self.reader)
+                tids.insert(0, self.reader)
+            for tid in tids:
+                try:
+                    with open(os.path.join(taskDir, tid, 'syscall')) as f:
+                        fields = f.read().split()
+                except IOError as err:
+                    if err.errno == errno.ENOENT:
+                        continue    # thread exited
+                    raise
+                if len(fields) > 1 and fields[0] in reads and int(fields[1], 16) == 0:
+                    self.reader = tid
+                    return True
+        except (IOError, OSError):
+            return None
+        return False
+
+    def kill(self, p):
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    # runs in the child before exec
+    def preexec(self):
+        os.setsid()
+        if self.limited:
+            for res, soft, hard in self.limits:
+                resource.setrlimit(res, (soft, hard))
+
+    # wait4() instead of Popen.wait() so the child's rusage isn't lost.
+    # Returns the exit status like Popen.returncode, None if still running.
+    def reap(self, p, options=0):
+        if p.returncode is None:
+            pid, status, usage = os.wait4(p.pid, options)
+            if pid == 0:
+                return None
+            self.usage = (usage.ru_utime, usage.ru_stime, usage.ru_maxrss)
+            if os.WIFSIGNALED(status):
+                p.returncode = -os.WTERMSIG(status)
+            else:
+                p.returncode = os.WEXITSTATUS(status)
+        return p.returncode
+
+    # Returns stdout and stderr as OutputBuffers
     def run(self, timeout):
-        # timeout not currently used.
-        def target():
-            P = subprocess.PIPE
-            
-            arg = ""
-            for x in self.args:
-                arg += x + " "
-            start = time.time()
-            last_output = time.time()
-            last_input = time.time()
-
-            p = subprocess.Popen(arg, shell=True, stdout=P, stderr=P, stdin=P)
-            fd = p.stdout.fileno()
-            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-            last_output = time.time()
-            last_input = time.time()
-            while p.poll() is None:
-                (rlist, wlist, xlist) = select.select([p.stdout], [p.stdin], [p.stderr])
-                
+        P = subprocess.PIPE
+        # no shell in between, so p.pid is the program itself for /proc lookups
+        p = subprocess.Popen(self.args, stdout=P, stderr=P, stdin=P,
+                             close_fds=True, preexec_fn=self.preexec)
+        prompt = self.pacing == 'prompt'
+        start = time.time()
+        deadline = start + timeout
+        last_output = time.time()
+        last_input = time.time()
+        poll = self.POLL
+        streams = {p.stdout.fileno(): 'out', p.stderr.fileno(): 'err'}
+        try:
+            while streams and not self.truncated:
+                now = time.time()
+                if now >= deadline:
+                    self.timedOut = True
+                    break
+                # stdin stays open until the program wants more than the input
+                feeding = self.input or not p.stdin.closed
+                # sleep until there is output, the next line is due, or time is up
+                wait = deadline - now
+                if feeding and prompt:
+                    wait = min(wait, poll)
+                elif feeding:
+                    nextLine = max(last_output, last_input) + self.PACE
+                    wait = min(wait, max(nextLine - now, 0))
+                (rlist, wlist, xlist) = select.select(list(streams), [], [], wait)
+
                 # Read the output of the program
-                if len(rlist) > 0:
-                    s = p.stdout.read()
-                    if len(s) > 0:
-                        self.out += s
+                for fd in rlist:
+                    s = os.read(fd, 65536)
+                    if len(s) == 0:
+                        del streams[fd]
+                        continue
+                    self.capture(streams[fd], s)
+                    if streams[fd] == 'out':
                         last_output = time.time()
-                # If we can write, it is more than .5s, and output has occured recently
-                if len(wlist) > 0 and time.time() - last_output > 0.5 and time.time()-last_input > 0.5:
-                    # Write out the next line of input
-                    if len(self.input) > 0:
-                        p.stdin.write(self.input[0])
-                        del self.input[0]
-                        last_input = time.time()
-            self.err += p.stderr.read()
-        target()
+                        poll = self.POLL    # probably a prompt
+                # Write out the next line as soon as the program blocks reading
+                # stdin, or once it has been quiet for PACE. With no lines
+                # left, close stdin then so the program reads EOF instead of
+                # waiting out its time budget.
+                now = time.time()
+                if feeding and prompt:
+                    due = self.waitingForInput(p)
+                    if due is None:
+                        prompt = False
+                        continue
+                    poll = self.POLL if due else min(poll * 2, self.MAX_POLL)
+                elif feeding:
+                    due = now - last_output > self.PACE and now - last_input > self.PACE
+                if feeding and due and not self.input:
+                    try:
+                        p.stdin.close()
+                    except IOError:
+                        pass    # already gone, see EPIPE below
+                elif feeding and due:
+                    self.paced += max(now - max(last_output, last_input), 0)
+                    try:
+                        p.stdin.write(self.input.pop(0))
+                        p.stdin.flush()
+                    except IOError as err:
+                        if err.errno != errno.EPIPE:
+                            raise
+                        self.input = []
+                    last_input = now
+            # pipes are closed, give the process until the deadline to exit
+            while not self.timedOut and not self.truncated and self.reap(p, os.WNOHANG) is None:
+                if time.time() >= deadline:
+                    self.timedOut = True
+                time.sleep(0.01)
+        finally:
+            if self.reap(p, os.WNOHANG) is None:
+                self.kill(p)
+            self.status = self.reap(p)
+            self.elapsed = time.time() - start
+            for f in (p.stdin, p.stdout, p.stderr):
+                f.close()
+            self.out.close()
+            self.err.close()
+        if self.timedOut:
+            raise TimeOutError(timeout)
         return self.out, self.err
 
-# Used to create and html file showing the difference between two strings
+# (resource, soft, hard) limits for test runs from the command line. The
+# hard CPU limit is a second past the soft one so the program gets SIGXCPU
+# before SIGKILL.
+def rlimits(args):
+    limits = []
+    if args.cpu_limit > 0:
+        limits.append((resource.RLIMIT_CPU, args.cpu_limit, args.cpu_limit + 1))
+    if args.mem_limit > 0:
+        limits.append((resource.RLIMIT_AS, args.mem_limit << 20, args.mem_limit << 20))
+    if args.nproc_limit > 0:
+        limits.append((resource.RLIMIT_NPROC, args.nproc_limit, args.nproc_limit))
+    if args.fsize_limit > 0:
+        limits.append((resource.RLIMIT_FSIZE, args.fsize_limit << 20, args.fsize_limit << 20))
+    return limits
+
+# java options for test runs
+def jvmOptions():
+    if Command.xmx:
+        return ['-Xmx' + Command.xmx]
+    return []
+
+# Which limit stopped a test run, None if none did. status and err are the
+# program's exit status and stderr, usage its rusage if known.
+def limitLabel(status, err, usage=None):
+    cpu = [limit for res, limit, hard in Command.limits if res == resource.RLIMIT_CPU]
+    if status == -signal.SIGXCPU or (cpu and status == -signal.SIGKILL and usage
+                                    and usage[0] + (usage[1] or 0) >= cpu[0]):
+        return 'CPU limit exceeded (%ds)' % cpu[0] if cpu else 'CPU limit exceeded'
+    if status == -signal.SIGXFSZ or 'File too large' in err:
+        return 'file size limit exceeded'
+    if 'unable to create native thread' in err or 'unable to create new native thread' in err:
+        return 'process limit exceeded'
+    if 'java.lang.OutOfMemoryError' in err or 'Could not reserve enough space' in err \
+            or 'Cannot allocate memory' in err:
+        return 'memory limit exceeded'
+    return None
+
+# one line about a test's resource use, for the console and its diff page
+def usageNote(test):
+    note = ''
+    usage = test.get('usage')
+    if usage is not None:
+        note = '%.2fs user' % usage[0]
+        if usage[1] is not None:
+            note += ', %.2fs sys' % usage[1]
+        if usage[2]:
+            note += ', %d MB max RSS' % (usage[2] >> 10)
+    if test.get('limit'):
+        note = '%s; %s' % (test['limit'], note) if note else test['limit']
+    if test.get('slow'):
+        slow = "%.1fx the solution's time" % test['slow']
+        note = '%s; %s' % (note, slow) if note else slow
+    return note
+
+# --folder, prepared once per session in .support/<hash of its files>/:
+# its .java helpers compiled into a shared classes/ directory that every
+# compile and run gets on its classpath, and a read-only copy of its data
+# files in data/ that work dirs hard-link to rather than copy. Helpers that
+# only compile together with the submission are staged and recompiled with
+# each student as before.
+class Support(object):
+    data = None         # read-only copy of the --folder data files
+    classes = None      # prebuilt --folder classes, None if there are none
+
+    @classmethod
+    def build(cls, dirname, folder):
+        names = sorted(f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)))
+        h = hashlib.sha1()
+        for name in names:
+            h.update(name + '\0')
+            hashFile(h, os.path.join(folder, name))
+        dirname = os.path.abspath(dirname)
+        target = os.path.join(dirname, h.hexdigest())
+        if not os.path.isdir(target):
+            if os.path.isdir(dirname):
+                shutil.rmtree(dirname)      # builds of an older --folder
+            tmp = target + '.%d' % os.getpid()
+            os.makedirs(os.path.join(tmp, 'data'))
+            os.makedirs(os.path.join(tmp, 'classes'))
+            sources = []
+            for name in names:
+                path = os.path.abspath(os.path.join(folder, name))
+                if name.endswith('.java'):
+                    sources.append(path)
+                else:
+                    shutil.copy(path, os.path.join(tmp, 'data'))
+                    os.chmod(os.path.join(tmp, 'data', name), 0444)
+            if sources:
+                classes = os.path.join(tmp, 'classes')
+                out, err = Command(['javac', '-nowarn', '-d', classes] + sources, '').run(timeout=60)
+                if out.getvalue() or err.getvalue():
+                    with open(os.path.join(tmp, 'javac.txt'), 'w') as f:
+                        f.write(out.getvalue() + err.getvalue())
+                    shutil.rmtree(classes)
+            os.rename(tmp, target)
+        cls.data = os.path.join(target, 'data')
+        classes = os.path.join(target, 'classes')
+        cls.classes = classes if os.path.isdir(classes) and os.listdir(classes) else None
+        if os.path.exists(os.path.join(target, 'javac.txt')):
+            logging.warning('--folder sources do not compile on their own (%s), '
+                            'compiling them with each submission', os.path.join(target, 'javac.txt'))
+
+# -cp for javac and java run in the cwd, empty (the default, '.') unless
+# there are prebuilt --folder classes
+def classPath():
+    if Support.classes:
+        return ['-cp', os.pathsep.join(['.', Support.classes])]
+    return []
+
+# Client for GradeRunner.java (--jvm-runner): one long-lived JVM per grading
+# process runs each test's main() in a fresh class loader. Java can't chdir,
+# so the JVM works in a scratch dir linked to the --folder data files which
+# is cleaned after every run.
+class JavaRunner(object):
+    home = None         # directory of the compiled harness, None if disabled
+    current = None      # this process's runner
+
+    # compile the harness into dirname and enable the runner
+    @classmethod
+    def build(cls, dirname):
+        source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'GradeRunner.java')
+        target = os.path.join(dirname, 'GradeRunner.class')
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        if not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(source):
+            if os.path.exists(target):
+                os.remove(target)
+            # deprecation notes about SecurityManager are expected here
+            out, err = Command(['javac', '-nowarn', '-d', dirname, source], '').run(timeout=60)
+            if not os.path.exists(target):
+                raise CompileError(out.getvalue(), err.getvalue(), source)
+        cls.home = os.path.abspath(dirname)
+
+    # the runner for this process, None when --jvm-runner is off
+    @classmethod
+    def get(cls):
+        if cls.home is None:
+            return None
+        if cls.current is None or cls.current.pid != os.getpid():
+            cls.current = cls()
+        return cls.current
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.proc = None
+        self.buf = ''
+        self.scratch = os.path.join(self.home, 'cwd-%d' % self.pid)
+        self.baseline = set()
+        self.status = None
+        self.elapsed = 0.0
+        self.usage = None
+
+    def start(self):
+        if not os.path.exists(self.scratch):
+            os.makedirs(self.scratch)
+        if Support.data:
+            for f in os.listdir(Support.data):
+                link(self.scratch, os.path.join(Support.data, f))
+        self.baseline = set(os.listdir(self.scratch))
+        self.buf = ''
+        with open(os.devnull, 'w') as devnull:
+            self.proc = subprocess.Popen(['java'] + jvmOptions() + ['-cp', self.home, 'GradeRunner'],
+                                         stdin=PIPE, stdout=PIPE, stderr=devnull,
+                                         cwd=self.scratch, close_fds=True, preexec_fn=self.preexec)
+
+    # like Command.preexec, except that a CPU limit would add up over every
+    # test this JVM runs; the request timeout covers that instead
+    def preexec(self):
+        os.setsid()
+        for res, soft, hard in Command.limits:
+            if res != resource.RLIMIT_CPU:
+                resource.setrlimit(res, (soft, hard))
+
+    def stop(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc = None
+
+    # remove whatever the last program created in the scratch dir
+    def clean(self):
+        for f in os.listdir(self.scratch):
+            if f not in self.baseline:
+                path = os.path.join(self.scratch, f)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+
+    def fill(self, deadline, timeout):
+        fd = self.proc.stdout.fileno()
+        wait = deadline - time.time()
+        if wait <= 0 or not select.select([fd], [], [], wait)[0]:
+            raise TimeOutError(timeout)
+        s = os.read(fd, 65536)
+        if len(s) == 0:
+            raise EOFError()
+        self.buf += s
+
+    # read one reply line (size None), or size bytes into the OutputBuffer
+    # sink, before the deadline
+    def read(self, size, deadline, timeout, sink=None):
+        if size is None:
+            while '\n' not in self.buf:
+                self.fill(deadline, timeout)
+            size = self.buf.index('\n') + 1
+            data, self.buf = self.buf[:size], self.buf[size:]
+            return data
+        while size > 0:
+            if not self.buf:
+                self.fill(deadline, timeout)
+            data, self.buf = self.buf[:size], self.buf[size:]
+            size -= len(data)
+            sink.write(data)
+        return sink
+
+    # send one request, returns (status, out, err, truncated, cpuMillis) with
+    # out and err as OutputBuffers, or None if the harness died. Files named
+    # in keep that the program wrote are moved to dirname before the scratch
+    # dir is cleaned.
+    def request(self, line, payload, timeout, spill=None, keep=(), dirname=None):
+        if self.proc is None:
+            self.start()
+        deadline = time.time() + timeout
+        try:
+            self.proc.stdin.write(line + payload)
+            self.proc.stdin.flush()
+            fields = self.read(None, deadline, timeout).split('\t')
+            if fields[0] != 'DONE' or len(fields) != 6:
+                raise ValueError('bad reply from GradeRunner: %r' % fields)
+            status, outLen, errLen = int(fields[1]), int(fields[2]), int(fields[3])
+            out = self.read(outLen, deadline, timeout, OutputBuffer(spill and spill + '.stdout'))
+            err = self.read(errLen, deadline, timeout, OutputBuffer(spill and spill + '.stderr'))
+            out.close()
+            err.close()
+        except TimeOutError:
+            self.stop()
+            raise
+        except (IOError, EOFError, ValueError):
+            # a garbled reply means the protocol stream can't be trusted
+            # any more, so it is handled like the harness dying
+            self.stop()
+            return None
+        finally:
+            for name in keep:
+                path = os.path.join(self.scratch, name)
+                if name not in self.baseline and os.path.exists(path):
+                    staging.move(dirname, path, name)
+            self.clean()
+        return status, out, err, fields[5].strip() == '1', int(fields[4])
+
+    # classDir plus the prebuilt --folder classes, if any
+    def classPath(self, classDir):
+        return os.pathsep.join([classDir] + ([Support.classes] if Support.classes else []))
+
+    # Run classname from classDir. Returns (out, err) OutputBuffers like
+    # Command, or None if the harness died (e.g. System.exit() without a
+    # SecurityManager) so the caller can fall back to a plain java process.
+    # Files named in keep (the -o output) are moved to classDir afterwards.
+    def run(self, classDir, classname, input, timeout, spill=None, keep=()):
+        start = time.time()
+        result = self.request('RUN\t%s\t%s\t%d\t%d\n' % (self.classPath(classDir), classname,
+                                    Command.maxOutput, len(input)), input, timeout, spill,
+                              keep, classDir)
+        if result is None:
+            return None
+        self.status, out, err, truncated, cpu = result
+        self.elapsed = time.time() - start
+        # the harness only measures the CPU time of the program's main thread
+        self.usage = (cpu / 1000.0, None, None)
+        if truncated:
+            out.write(TRUNCATED % Command.maxOutput)
+            out.close()
+        return out, err
+
+    # javac -nowarn source inside dirname. Returns (out, err) like Command,
+    # or None if the harness can't compile (died, or running on a JRE).
+    def compile(self, dirname, source, timeout):
+        result = self.request('COMPILE\t%s\t%s\t%s\n' % (dirname, source, self.classPath(dirname)),
+                              '', timeout)
+        if result is None or result[0] == -1:
+            return None
+        status, out, err, truncated, cpu = result
+        # report paths relative to dirname, as javac run there would
+        prefix = os.path.join(dirname, '')
+        return out.getvalue().replace(prefix, ''), err.getvalue().replace(prefix, '')
+
+
+# Myers O((N+M)D) line diff of two lists of hashable lines. Returns
+# difflib-style opcodes (tag, i1, i2, j1, j2), or None if more than maxD
+# lines would have to change, so callers can bail out on junk output.
+def lineDiff(a, b, maxD):
+    # trim the common prefix and suffix, usually most of the output
+    lo = 0
+    while lo < len(a) and lo < len(b) and a[lo] == b[lo]:
+        lo += 1
+    hiA, hiB = len(a), len(b)
+    while hiA > lo and hiB > lo and a[hiA - 1] == b[hiB - 1]:
+        hiA -= 1
+        hiB -= 1
+    x0, y0 = a[lo:hiA], b[lo:hiB]
+    n, m = len(x0), len(y0)
+
+    v = {1: 0}
+    trace = []
+    found = False
+    for d in xrange(min(maxD, n + m) + 1):
+        trace.append(v.copy())
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and x0[x] == y0[y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                found = True
+                break
+        if found:
+            break
+    if not found:
+        return None
+
+    # walk the trace back from the end into single-line edits
+    edits = []
+    x, y = n, m
+    for d in xrange(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prevK = k + 1
+        else:
+            prevK = k - 1
+        prevX = v[prevK]
+        prevY = prevX - prevK
+        while x > prevX and y > prevY:
+            x -= 1
+            y -= 1
+            edits.append(('equal', x, y))
+        if d > 0:
+            edits.append(('insert' if x == prevX else 'delete', prevX, prevY))
+        x, y = prevX, prevY
+    edits.reverse()
+
+    # group into opcodes, pairing deletes with inserts as replaces
+    codes = []
+    if lo > 0:
+        codes.append(['equal', 0, lo, 0, lo])
+    for tag, x, y in edits:
+        i, j = x + lo, y + lo
+        di = 0 if tag == 'insert' else 1
+        dj = 0 if tag == 'delete' else 1
+        if codes and codes[-1][0] != 'equal' and tag != 'equal':
+            last = codes[-1]
+            if last[0] != tag:
+                last[0] = 'replace'
+            last[2] += di
+            last[4] += dj
+        elif codes and codes[-1][0] == tag:
+            codes[-1][2] += di
+            codes[-1][4] += dj
+        else:
+            codes.append([tag, i, i + di, j, j + dj])
+    if hiA < len(a):
+        codes.append(['equal', hiA, len(a), hiB, len(b)])
+    return [tuple(c) for c in codes]
+
+
+DIFF_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>diff</title>
+<style>
+table.diff {font-family: monospace; border-collapse: collapse}
+table.diff td {white-space: pre; padding: 0 4px; vertical-align: top}
+table.diff th {background: #eee; text-align: left; padding: 0 4px}
+td.num {color: #999; text-align: right}
+td.chg {background: #ffff77} td.del {background: #ffaaaa} td.add {background: #aaffaa}
+tr.skip td {background: #eeeeff; color: #666699}
+</style></head><body>
+<p>%s</p>
+<table class="diff">
+<tr><th></th><th>solution</th><th></th><th>student</th></tr>
+%s
+</table></body></html>
+"""
+
+# How Difference compares lines, by name
+WHITESPACE = {
+    'rstrip': lambda line: line.rstrip(),           # ignore trailing whitespace
+    'exact': lambda line: line,
+    'ignore': lambda line: ''.join(line.split()),   # ignore all whitespace
+}
+
+# Used to create and html file showing the difference between two strings.
+# Lines are compared with trailing whitespace stripped (or as 'whitespace'
+# says). Small outputs are shown in full; large ones only around the
+# changes. The student side may be an OutputBuffer, which is only loaded to
+# render a diff.
 class Difference(object):
-    def __init__(self, solution, student):
+    CONTEXT = 3             # unchanged lines kept around each change
+    FULL_LINES = 500        # above this many lines, collapse unchanged runs
+    MAX_EDITS = 1000        # stop aligning beyond this many changed lines
+    pool = None             # this process's diff worker
+    poolPid = None
+
+    # note - extra line for the top of the page, e.g. the run's resource use
+    # whitespace - key of WHITESPACE
+    def __init__(self, solution, student, note='', whitespace='rstrip'):
+        if not isinstance(student, OutputBuffer):
+            student = OutputBuffer.of(student)
         self.solution = solution
         self.student = student
-    def target(self, self2, queue):
-        solutions = self.solution.splitlines(True)
-        students = self.student.splitlines(True)
-        for i in range(len(solutions)):
-            solutions[i] = solutions[i].rstrip() + "\n"
-        for i in range(len(students)):
-            students[i] = students[i].rstrip() + "\n"
-        htmlDiff = difflib.HtmlDiff()
-
-        queue.put(htmlDiff.make_file(
-                                solutions,
-                                students,
-                                fromdesc='solution',
-                                todesc='student'))
-        queue.close()
-
+        self.note = note
+        self.whitespace = whitespace
+        self.norm = WHITESPACE[whitespace]
+        lines = list(OutputBuffer.of(solution).lines())
+        self.solutions = [line.rstrip() for line in lines]
+        self.keys = [self.norm(line) for line in lines]
+        self.students = None
+
+    # compares line by line without loading the student's output
+    def identical(self):
+        n = 0
+        for n, line in enumerate(self.student.lines(), 1):
+            if n > len(self.keys) or self.norm(line) != self.keys[n - 1]:
+                return False
+        return n == len(self.keys)
+
+    def row(self, i, j, cls):
+        left = right = ''
+        if i is not None:
+            left = cgi.escape(self.solutions[i])
+        if j is not None:
+            right = cgi.escape(self.students[j])
+        return '<tr><td class="num">%s</td><td class="%s">%s</td><td class="num">%s</td><td class="%s">%s</td></tr>' % (
+            '' if i is None else i + 1, cls if i is not None else '', left,
+            '' if j is None else j + 1, cls if j is not None else '', right)
+
+    def html(self):
+        if self.students is None:
+            self.students = [line.rstrip() for line in self.student.lines()]
+        a, b = self.solutions, self.students
+        if self.identical():
+            codes = [('equal', 0, len(a), 0, len(b))]
+        else:
+            # compare by id so long lines are hashed once
+            ids = {}
+            codes = lineDiff([ids.setdefault(l, len(ids)) for l in self.keys],
+                             [ids.setdefault(self.norm(l), len(ids)) for l in self.student.lines()],
+                             self.MAX_EDITS)
+            if codes is None:
+                codes = [('replace', 0, len(a), 0, len(b))]
+        compact = max(len(a), len(b)) > self.FULL_LINES
+        rows = []
+        changed = 0
+        for n, (tag, i1, i2, j1, j2) in enumerate(codes):
+            if tag == 'equal':
+                keep = range(i2 - i1)
+                if compact and i2 - i1 > 2 * self.CONTEXT:
+                    head = self.CONTEXT if n > 0 else 0
+                    tail = self.CONTEXT if n < len(codes) - 1 else 0
+                    keep = range(head) + [None] + range(i2 - i1 - tail, i2 - i1)
+                for off in keep:
+                    if off is None:
+                        rows.append('<tr class="skip"><td></td><td colspan="3">... %d identical lines ...</td></tr>'
+                                    % (i2 - i1 - head - tail))
+                    else:
+                        rows.append(self.row(i1 + off, j1 + off, ''))
+                continue
+            size = max(i2 - i1, j2 - j1)
+            changed += size
+            if compact and size > self.FULL_LINES:
+                size = self.FULL_LINES
+            for off in xrange(size):
+                i = i1 + off if i1 + off < i2 else None
+                j = j1 + off if j1 + off < j2 else None
+                cls = 'chg' if tag == 'replace' and i is not None and j is not None else \
+                      ('del' if j is None else 'add')
+                rows.append(self.row(i, j, cls))
+            if size < max(i2 - i1, j2 - j1):
+                rows.append('<tr class="skip"><td></td><td colspan="3">... %d more changed lines ...</td></tr>'
+                            % (max(i2 - i1, j2 - j1) - size))
+        summary = 'Output matches the solution.' if changed == 0 else \
+                  '%d line(s) differ from the solution.' % changed
+        if self.note:
+            summary += '<br>' + cgi.escape(self.note)
+        return DIFF_PAGE % (summary, '\n'.join(rows))
+
+    # Render in this process's persistent diff worker so a pathological
+    # diff can be abandoned after timeout seconds
     def run(self, timeout):
-        queue = multiprocessing.Queue(1) # Maximum size is 1
-        proc = multiprocessing.Process(target=self.target, args=(self, queue))
-        proc.start()
-        # Wait for TIMEOUT seconds
+        if self.identical():
+            return self.html()
+        if Difference.pool is None or Difference.poolPid != os.getpid():
+            Difference.pool = multiprocessing.Pool(1)
+            Difference.poolPid = os.getpid()
         try:
-            result = queue.get(True, timeout)
-        except Queue.Empty:
+            result = Difference.pool.apply_async(renderDiff, (self.solution, self.student, self.note, self.whitespace)).get(timeout)
+        except multiprocessing.TimeoutError:
+            Difference.pool.terminate()
+            Difference.pool = None
             # Deal with lack of data somehow
-            result = "Wrong\n"
-            for line in self.student.splitlines(True):
-                result+= line
-        finally:
-            proc.terminate()
+            result = "Wrong\n" + self.student.getvalue()
         return result
 
 
+# diff worker entry point for Difference.run
+def renderDiff(solution, student, note='', whitespace='rstrip'):
+    return Difference(solution, student, note, whitespace).html()
+
+
+# One line of the rubric. Lines are shared by every student; a student's
+# scores live in a rubrics row.
 class rubricLine(object):
     def __init__(self, fullC, graderProp, studentProp) :
         if fullC > 0 :
@@ -149,48 +1003,69 @@ class rubricLine(object):
         else :
           self.fc = 0
           self.dc = -fullC
-        self.sc = self.fc     # default student score
         self.gp = graderProp
         self.sp = studentProp
 
     def getStudentScore(self) :
         maxP = self.dc
         if self.fc != 0 :
-          self.sc = get_Int(self.gp + '\t' + str(maxP) + ':\t', 0, maxP, maxP)
+          return get_Int(self.gp + '\t' + str(maxP) + ':\t', 0, maxP, maxP)
         else :
-          self.sc = get_Int(self.gp + '\t' + str(-maxP) + ':\t', -maxP, 0, 0)
-
-    def isFullCredit(self) :
-        return self.sc == self.fc
-
-    def printFeedback(self) :
-        return '(-' + str(self.fc - self.sc) + ')  ' +  self.sp 
-
+          return get_Int(self.gp + '\t' + str(-maxP) + ':\t', -maxP, 0, 0)
+
+    def printFeedback(self, sc) :
+        return '(-' + str(self.fc - sc) + ')  ' +  self.sp 
+
+# The rubric file parsed once: its lines in order, grouped by key word,
+# with the full-credit totals worked out up front
+class RubricTemplate(object):
+    loaded = {}     # path -> (mtime, RubricTemplate)
+
+    def __init__(self, lines):
+        self.lines = tuple(rl for kw, rl in lines)      # rubricLine per row index
+        self.keywords = tuple(kw for kw, rl in lines)   # key word per row index
+        kws = []
+        byKw = defaultdict(list)
+        for i, (kw, rl) in enumerate(lines):
+            if kw not in byKw:
+                kws.append(kw)
+            byKw[kw].append(i)
+        self.kws = tuple(kws)
+        self.byKw = dict((kw, tuple(rows)) for kw, rows in byKw.items())
+        self.kwFull = dict((kw, sum(self.lines[i].fc for i in rows)) for kw, rows in self.byKw.items())
+        self.full = max(sum(self.kwFull.values()), 0)
+
+    @classmethod
+    def load(cls, path):
+        mtime = os.path.getmtime(path)
+        if path not in cls.loaded or cls.loaded[path][0] != mtime:
+            cls.loaded[path] = (mtime, cls(parseRubric(path)))
+        return cls.loaded[path][1]
+
+    # a student's scores before grading: full credit on every line
+    def row(self):
+        return array.array('i', [rl.fc for rl in self.lines])
+
+# One student's rubric: the shared template plus an array of scores, one
+# per template line
 class rubrics(object):
-    def __init__(self):
-        self.dicts = defaultdict(list)
-        self.kws = []
-
-    def addRubric(self, rl, keyWord) :
-        if keyWord not in self.kws :
-            self.dicts[keyWord] = []
-            self.kws.append(keyWord)
-        self.dicts[keyWord].append(rl)
+    def __init__(self, template, row=None):
+        self.template = template
+        self.row = template.row() if row is None else row
 
     # get subtotal for a key word, True for student, False for full credit
     def subTotal(self, keyWord, student) :
-        assert keyWord in self.dicts
-        total = 0
-        for rl in self.dicts[keyWord] :
-            total += rl.sc if student else rl.fc
-        return total
+        assert keyWord in self.template.byKw
+        if not student:
+            return self.template.kwFull[keyWord]
+        row = self.row
+        return sum(row[i] for i in self.template.byKw[keyWord])
 
     # get total score, True for student, False for full credit
     def getTotal(self, student) :
-        total = 0
-        for kw in self.dicts :
-            total += self.subTotal(kw, student)
-        return max(total, 0)
+        if not student:
+            return self.template.full
+        return max(sum(self.row), 0)
 
     def printTotal(self) :
         return "%d/%d" % (self.getTotal(True), self.getTotal(False))
@@ -200,16 +1075,77 @@ class rubrics(object):
 
     def getKWdetail(self, keyWord) :
         detail = []
-        for rl in self.dicts[keyWord] :
-            if not rl.isFullCredit() :
-                detail.append(rl.printFeedback())
+        for i in self.template.byKw[keyWord] :
+            rl = self.template.lines[i]
+            if self.row[i] != rl.fc :
+                detail.append(rl.printFeedback(self.row[i]))
         return detail
 
     def getAllKw(self) :
-        return self.kws;
+        return self.template.kws
 
     def isFullCredit(self) :
-        return self.getTotal(True) == self.getTotal(False)
+        return self.getTotal(True) == self.template.full
+
+# Every graded student's rubric row for the session, by Canvas ID, for
+# class-wide totals and per-line statistics
+class ScoreMatrix(object):
+    def __init__(self, template):
+        self.template = template
+        self.rows = {}
+
+    def add(self, cid, row):
+        self.rows[cid] = array.array('i', row)
+
+    def totals(self):
+        return dict((cid, max(sum(row), 0)) for cid, row in self.rows.items())
+
+    # (key word, line, mean deduction, students deducted) per rubric line
+    def stats(self):
+        lines = self.template.lines
+        lost = [0] * len(lines)
+        hit = [0] * len(lines)
+        for row in self.rows.values():
+            for i, sc in enumerate(row):
+                if sc != lines[i].fc:
+                    lost[i] += lines[i].fc - sc
+                    hit[i] += 1
+        n = max(len(self.rows), 1)
+        return [(self.template.keywords[i], rl.gp, lost[i] / float(n), hit[i])
+                for i, rl in enumerate(lines)]
+
+    def report(self):
+        if not self.rows:
+            return
+        print "Rubric deductions over %d student(s):" % len(self.rows)
+        for kw, gp, mean, hit in self.stats():
+            print "  %-12s %-30s mean -%.2f, %d deducted" % (kw, gp, mean, hit)
+
+    # Move every row onto template, e.g. a rubric file whose weights were
+    # changed after grading. Lines are matched by key word and position
+    # under it; each keeps its deduction, clamped to the new line's range.
+    def rescore(self, template):
+        old = dict((key, j) for j, key in enumerate(positions(self.template)))
+        matrix = ScoreMatrix(template)
+        for cid, row in self.rows.items():
+            new = template.row()
+            for i, key in enumerate(positions(template)):
+                if key in old:
+                    j = old[key]
+                    lost = self.template.lines[j].fc - row[j]
+                    rl = template.lines[i]
+                    new[i] = min(max(rl.fc - lost, rl.fc - rl.dc), rl.fc)
+            matrix.rows[cid] = new
+        return matrix
+
+# (key word, position under it) of each line of template
+def positions(template):
+    keys = []
+    seen = defaultdict(int)
+    for kw in template.keywords:
+        keys.append((kw, seen[kw]))
+        seen[kw] += 1
+    return keys
 
 class format(object) :
     def __init__(self):
@@ -233,81 +1169,261 @@ class format(object) :
 
 
 
+# Stage --folder into dirname: the data files from Support.data, and the helper
+# sources only when they couldn't be prebuilt (see Support)
 def move_required(dirname, folder):
     for f in os.listdir(folder):
-        copy(dirname, os.path.join(folder, f))
+        if not os.path.isfile(os.path.join(folder, f)):
+            continue
+        if not f.endswith('.java'):
+            link(dirname, os.path.join(Support.data, f))
+        elif Support.classes is None:
+            copy(dirname, os.path.join(folder, f))
 
 def getInput(source):
-    input = ""
     with open(source) as src:
-        for line in src:
-            input += line
-    return input
+        return src.read()
 
+# Copy source into dirname, named like dest. A real copy: feedback and
+# work dir copies get written to, and a link would write through to turnin.
 def move(dirname, source, dest):
-    target = os.path.join(dirname, os.path.basename(dest))
-    with open(target, 'w') as sink:
-        with open(source) as src:
-            for line in src:
-                sink.write(line)
-                
+    with span('staging'):
+        staging.copy(source, os.path.join(dirname, os.path.basename(dest)))
+
 def copy(dirname, source):
     move(dirname, source, source)
+
+# Hard link a file nothing writes to (Support.data) into dirname
+def link(dirname, source):
+    with span('staging'):
+        staging.place(dirname, source)
+
+# Move a turnin file into one of the sorting folders
+def shelve(dirname, source):
+    with span('staging'):
+        staging.move(dirname, source)
+
+# Keep a copy of the Canvas CSV as .<name> before it is rewritten
+def backup(startDir, info):
+    staging.copy(info, os.path.join(startDir, os.path.basename('.' + info)))
     
 def getOut(dirname, source):
-    ret = ""
     target = os.path.join(dirname, source)
     with open(source) as src:
-        for line in src:
-            ret += line
-    return ret
+        return src.read()
     
 # Compiles a java file at 'source'
 def compile(source):
     if not os.path.exists(source):
         raise IOError('File does not exist: %s' % source) 
     logging.debug('%s: compiling', source)
-    args = ['javac', '-nowarn', source]
-    command = Command(args, '')
-    out, err = command.run(timeout=5)
+    with span('compile'):
+        runner = JavaRunner.get()
+        result = None
+        if runner:
+            result = runner.compile(os.getcwd(), source, timeout=30)
+        if result is None:
+            args = ['javac', '-nowarn'] + classPath() + [source]
+            command = Command(args, '')
+            out, err = command.run(timeout=30)
+            result = out.getvalue(), err.getvalue()
+    out, err = result
     if out or err:
         raise CompileError(out, err, source)      
 
 # classname - Name of class file to execute
 # inputName - Optional file name that contains input for the program
 # outputName - Optional file name that contains expected output for the program
-def run(classname, inputName, outputName):
+# stats - Optional dict to fill with the output file, stderr, exit status and time
+# timeout - Seconds of wall time before the program is killed
+# Returns [out, expected]: the program's output as an OutputBuffer, saved
+# to <input>.stdout, and the expected text.
+def run(classname, inputName, outputName, stats=None, timeout=20):
     if inputName is not None:
         input = getInput(inputName)
     else:
         input = ''
     print 'Running %s test case' % inputName
-    args = ['java', classname]
-    command = Command(args, input)
-    out, err = command.run(timeout=20)
-    # Not currently implemented
-    if err == "TIME OUT":
+    if stats is None:
+        stats = {}
+    runner = JavaRunner.get()
+    result = None
+    spill = os.path.abspath(inputName or classname)
+    # output of an earlier run must not outlive a run that times out
+    for path in (spill + '.stdout', spill + '.stderr', outputName):
+        if path and os.path.exists(path):
+            os.remove(path)
+    try:
+        with span('run', test=inputName) as tags:
+            if runner:
+                result = runner.run(os.getcwd(), classname, input, timeout=timeout, spill=spill,
+                                    keep=[outputName] if outputName else [])
+                command = runner
+            if result is None:
+                args = ['java'] + jvmOptions() + classPath() + [classname]
+                command = Command(args, input, limited=True, spill=spill)
+                result = command.run(timeout=timeout)
+                tags['paced'] = command.paced
+        out, err = result
+    except TimeOutError as timeout:
         print "Timed out..."
-        return ["TIME OUT", None]
+        stats['time'] = timeout.time
+        raise
+    err = err.getvalue()
     if err:
-        return [out +'\n\n' + err, None]
+        out.write('\n\n' + err)
+        out.close()
+    # the output stays in its file, for serve, rather than in the result cache
+    out.save()
+    stats.update(outFile=out.path, err=err, status=command.status, time=command.elapsed,
+                 usage=command.usage, limit=limitLabel(command.status, err, command.usage))
+    if stats['limit']:
+        print "Stopped: %s" % stats['limit']
+    if err:
+        return [out, None]
     if outputName:
         return [out, getOut('.', outputName)]
     else:        
         return [out, None]
 
-def diff(solution, student):
+# sha1 of output with each line rstripped, the way Difference compares them
+def outputHash(output):
+    if not isinstance(output, OutputBuffer):
+        output = OutputBuffer.of(output)
+    h = hashlib.sha1()
+    for line in output.lines():
+        h.update(line.rstrip() + '\n')
+    return h.hexdigest()
+
+# page published instead of a diff for output that matches the solution
+def passPage(note=''):
+    summary = 'Output matches the solution.'
+    if note:
+        summary += '<br>' + cgi.escape(note)
+    return DIFF_PAGE % (summary, '')
+
+def diff(solution, student, note=''):
     '''Diff the contents of instructor and student output.'''
-    command = Difference(solution, student)
-    return command.run(timeout=15)
-
-def runStudent(args, startDir, match_obj, solutions) : 
+    command = Difference(solution, student, note)
+    with span('diff'):
+        return command.run(timeout=15)
+
+# Cache key of a submission's results: its turnin file name and source
+# plus the golden key, which already covers the solution, --folder and the
+# tests. The name matters since the record holds cid-named files, and two
+# students may well hand in the same source. The time budget settings are
+# in too, since a pass under a looser budget may be a timeout under this one.
+RESULTS = 5     # bump when the cached record layout changes
+
+def resultKey(args, origin):
+    h = hashlib.sha1('%s%s%d' % (args.golden, args.solution, RESULTS))
+    h.update(repr((args.budget_factor, args.budget_slack, args.slow_factor)))
+    h.update(os.path.basename(origin) + '\0')
+    hashFile(h, origin)
+    return h.hexdigest()
+
+def loadResult(startDir, key):
+    path = os.path.join(startDir, 'cache', key + '.pickle')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def saveResult(startDir, key, record):
+    path = os.path.join(makeFolder(startDir, 'cache'), key + '.pickle')
+    with open(path + '.%d' % os.getpid(), 'wb') as f:
+        pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(path + '.%d' % os.getpid(), path)
+
+# Diff pages by content in diff/.store. Every student's copy of a page is a
+# hard link to the one stored file, so identical wrong outputs across the
+# class are rendered and kept once.
+class DiffStore(object):
+    def __init__(self, diffRoot):
+        self.root = makeFolder(diffRoot, '.store')
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.html')
+
+    def has(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, text):
+        path = self.path(key)
+        with open(path + '.%d' % os.getpid(), 'w') as out:
+            out.write(text)
+        os.rename(path + '.%d' % os.getpid(), path)
+        return key
+
+    # store text under its own hash
+    def add(self, text):
+        key = hashlib.sha1(text).hexdigest()
+        if not self.has(key):
+            self.put(key, text)
+        return key
+
+    # make target a link to the stored page, or a copy where links can't go
+    def link(self, key, target):
+        staging.place(os.path.dirname(target), self.path(key), os.path.basename(target))
+
+# key of the diff page between a solution and a student output, from their
+# outputHash()es and the note shown on the page
+def diffKey(solutionHash, studentHash, note):
+    return hashlib.sha1('%s %s %s' % (solutionHash, studentHash, note)).hexdigest()
+
+# link the stored page key into diffFolder as dest and remember it in the
+# test's record so a cached rerun can do the same
+def publish(dest, key, diffFolder, args, test):
+    DiffStore(os.path.dirname(diffFolder)).link(key, os.path.join(diffFolder, dest))
+    test['files'].append((dest, key))
+
+# Redo the file side effects of a cached testStudent result
+def replayResult(record, diffFolder, args):
+    if not record['compiled']:
+        with open('compile.txt', 'w') as out:
+            out.write(record['compile'])
+        return record
+    for test in record['tests']:
+        files, test['files'] = test['files'], []
+        for dest, key in files:
+            publish(dest, key, diffFolder, args, test)
+    return record
+
+# True if every page a cached record links to is still in the store
+def isStored(record, diffFolder):
+    store = DiffStore(os.path.dirname(diffFolder))
+    return all(store.has(key) for test in record['tests'] for dest, key in test['files'])
+
+# Compile and run one submission, writing diffs against the solutions.
+# Returns False if it doesn't compile.
+def runStudent(args, startDir, match_obj, solutions) :
+    return testStudent(args, startDir, match_obj, solutions)['compiled']
+
+# What a submission's results look like from the outside: whether it
+# compiled, and each test's output hash, timeout and limit. None when that
+# says too little to share scores on: no tests, or a test without output.
+def fingerprint(record):
+    if not record['tests'] or any(test.get('hash') is None for test in record['tests']):
+        return None
+    return (record['compiled'],) + tuple((test.get('hash'), test['timeout'], test.get('limit'))
+                                         for test in record['tests'])
+
+# True if record compiled and passed every test
+def allPassed(record):
+    return record['compiled'] and len(record['tests']) > 0 and \
+        all(test['passed'] for test in record['tests'])
+
+# runStudent, returning the whole record of the compile and of each test.
+# Results are cached in cache/ by resultKey, so rerunning an unchanged
+# submission only replays its files.
+def testStudent(args, startDir, match_obj, solutions) : 
     filename = match_obj.group(0)
     lastName = match_obj.group(1)
     firstName = match_obj.group(2)
     cid = match_obj.group(3)
     fid = match_obj.group(4)
     htmlName = id2Str(int(fid))
+    Profile.tags = {'cid': cid}
     os.chdir(startDir)
     sourceFolder = os.path.join(startDir, 'work', cid)
     diffFolder = os.path.join(startDir, 'diff', htmlName)
@@ -318,6 +1434,13 @@ def runStudent(args, startDir, match_obj, solutions) :
 
     source = os.path.join(sourceFolder, args.solution)
     origin = os.path.join(startDir, args.turnin, filename)
+    key = resultKey(args, origin)
+    record = loadResult(startDir, key)
+    if record is not None and isStored(record, diffFolder):
+        print (" %s, %s, (%s): using cached results" % (lastName, firstName, cid))
+        os.chdir(sourceFolder)
+        return saveState(sourceFolder, replayResult(record, diffFolder, args))
+
     move(sourceFolder, origin, source)
     fname = args.solution
     classname = os.path.basename(fname).replace('.java', '')
@@ -326,71 +1449,489 @@ def runStudent(args, startDir, match_obj, solutions) :
     if args.folder:
         move_required(sourceFolder, args.folder)
     os.chdir(sourceFolder)
+    record = {'file': filename, 'cid': cid, 'compiled': False, 'compile': '', 'tests': []}
+    # timeouts and IO errors may be transient, only cache clean results
+    cacheable = True
     try:
-        compile(fname)
+        # --precompile already built this exact submission
+        if not (args.precompile and isCompiled(fname, origin)):
+            compile(fname)
+        record['compiled'] = True
         io = map(None, args.input, args.output)
+        # outputs matching these skip the diff
+        digests = [(outputHash(out), expected and outputHash(expected))
+                   for out, expected in solutions]
+        store = DiffStore(os.path.dirname(diffFolder))
         pos = 0
-        directory = os.listdir(os.getcwd())
         for cur in io:
+            test = {'input': cur[0], 'outFile': None, 'err': '', 'status': None,
+                    'time': 0.0, 'timeout': False, 'passed': False, 'hash': None,
+                    'usage': None, 'limit': None, 'slow': None, 'files': []}
+            record['tests'].append(test)
             try:
-                studPrint, studOut = run(classname, cur[0], cur[1])
-                difference = diff(solutions[pos][0], studPrint)
+                studPrint, studOut = run(classname, cur[0], cur[1], test, budget(args, pos))
+                printHash = outputHash(studPrint)
+                outHash = studOut and outputHash(studOut)
+                test['hash'] = printHash + (outHash and ' ' + outHash or '')
+                test['passed'] = printHash == digests[pos][0]
+                if studOut:
+                    test['passed'] &= outHash == digests[pos][1]
+                if test['passed']:
+                    test['slow'] = slowdown(args, pos, test['time'])
+                print "%s: %s, %s" % (cur[0], 'passed' if test['passed'] else 'differs', usageNote(test))
+                # run times differ for everyone, so pages only show the limit
+                # that stopped the program and stay shareable
+                note = test['limit'] or ''
                 dest = cid + "_" + cur[0] + '_diff' + '.html'
-                diffOut = open(dest, 'w')
-                for line in difference:
-                    diffOut.write(line)
-                diffOut.close()
+                if test['passed']:
+                    publish(dest, store.add(passPage(note)), diffFolder, args, test)
+                    pos += 1
+                    continue
+                page = diffKey(digests[pos][0], printHash, note)
+                if not store.has(page):
+                    store.put(page, diff(solutions[pos][0], studPrint, note))
+                publish(dest, page, diffFolder, args, test)
                 if studOut:
-                    difference = diff(solutions[pos][1], studOut)
-                    dest = eid+"_"+cur[1]+'_diff'+'.html'
-                    diffOut = open(dest, 'w')
-                    for line in difference:
-                        diffOut.write(line)
-                    diffOut.close()
+                    page = diffKey(digests[pos][1], outHash, note)
+                    if not store.has(page):
+                        store.put(page, diff(solutions[pos][1], studOut, note))
+                    dest = cid+"_"+cur[1]+'_diff'+'.html'
+                    publish(dest, page, diffFolder, args, test)
             except TimeOutError:
-                    # Not implemented
                 logging.error("Time Out")
-                dest = cid + '_timeout.txt'
-                diffOut = open(dest, 'w')
-                diffOut.write("Time Out Error")
-                diffOut.close()
+                test['timeout'] = True
+                cacheable = False
+                text = "Time Out Error (%.1fs budget)" % budget(args, pos)
+                publish(cid + '_timeout.txt', store.add(text), diffFolder, args, test)
             except IOError as err:
-                error = 'eid ' +str(eid)+': IO error\n'+str(err)
+                error = 'cid ' +str(cid)+': IO error\n'+str(err)
                 logging.error(error)
+                cacheable = False
             pos += 1
-            copy(diffFolder, dest)
-            if args.webbrowser :
-                webbrowser.open_new_tab("file://" + os.path.join(diffFolder, dest))
-            '''
-            newDir = os.listdir(os.getcwd())
-            outDir = 'test %s' % pos
-            for x in newDir:
-                if x not in directory and not os.path.isdir(x):
-                    if not os.path.exists(outDir):
-                        os.makedirs(outDir)
-                    outX = os.path.join(outDir, x)
-                    if os.path.exists(os.path.join(outDir, x)):
-                        os.remove(os.path.join(outDir, x))
-                    os.rename(x, outX)
-            '''
-    except (CompileError, IOError) as err:
-        error = 'cid ' +str(cid)+': compilation failed\n'+str(err)
-        logging.error(error)
-        dest = os.path.join("compile.txt")
-        out = open(dest, 'w')
-        out.write(error)
-        out.close() 
-        return False
+    except CompileError as err:
+        record['compile'] = compileFailed(cid, err)
+        saveResult(startDir, key, record)
+        return saveState(sourceFolder, record)
+    except (TimeOutError, IOError) as err:
+        record['compile'] = compileFailed(cid, err)
+        return saveState(sourceFolder, record)
+    if cacheable:
+        saveResult(startDir, key, record)
     print ("cid %s: finished tests" % (cid))
+    return saveState(sourceFolder, record)
+
+# Write the summary of record's latest run to <folder>/STATE for serve,
+# which can't tell a timeout or compile error from the saved outputs alone.
+# Returns record.
+STATE = '.results.json'
+
+def saveState(folder, record):
+    path = os.path.join(folder, STATE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(summarize(record), f)
+    os.rename(path + '.tmp', path)
+    return record
+
+
+# write compile.txt for a submission that failed to build, in the cwd,
+# and return its text
+def compileFailed(cid, err):
+    error = 'cid ' +str(cid)+': compilation failed\n'+str(err)
+    if isinstance(err, CompileError):
+        error += err.out + err.err
+    logging.error(error)
+    out = open('compile.txt', 'w')
+    out.write(error)
+    out.close()
+    return error
+
+
+# True if source's class file was built after the turnin file was written
+def isCompiled(source, origin):
+    target = source.replace('.java', '.class')
+    return os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(origin)
+
+
+# Stage a submission into work/<cid> and compile it (--precompile).
+# Returns False if it does not compile.
+def compileStudent(args, startDir, filename):
+    match_obj = re.match(FPATTERN, filename)
+    cid = match_obj.group(3)
+    os.chdir(startDir)
+    origin = os.path.join(startDir, args.turnin, filename)
+    record = loadResult(startDir, resultKey(args, origin))
+    if record is not None:
+        return record['compiled']
+    sourceFolder = makeFolder(os.path.join(startDir, 'work'), cid)
+    move(sourceFolder, origin, args.solution)
+    if args.folder:
+        move_required(sourceFolder, args.folder)
+    os.chdir(sourceFolder)
+    try:
+        compile(args.solution)
+    except (CompileError, TimeOutError, IOError) as err:
+        compileFailed(cid, err)
+        return False
     return True
 
 
-# Compile solution and generate golden
+# Prefetcher job running testStudent on a turnin file name, returns
+# (compiled, passed every test, fingerprint, paths of its diff pages).
+# The pages are opened (-w) by the main loop once it is the student's turn.
+def studentJob(args, startDir, solutions, filename):
+    match_obj = re.match(FPATTERN, filename)
+    record = testStudent(args, startDir, match_obj, solutions)
+    diffFolder = os.path.join(startDir, 'diff', id2Str(int(match_obj.group(4))))
+    pages = [os.path.join(diffFolder, dest) for test in record['tests'] for dest, key in test['files']]
+    return record['compiled'], allPassed(record), fingerprint(record), pages
+
+
+# Submissions with the same fingerprint(): the correctness scores the
+# grader gives one of them are offered for the rest
+class Cluster(object):
+    def __init__(self):
+        self.members = []       # turnin file names
+        self.scores = None      # {rubric row: score} of the correctness lines
+
+
+# studentJob for every file up front on --jobs processes, for --cluster.
+# Returns {file name: studentJob result}.
+def runAll(args, startDir, solutions, filenames):
+    print "Running %d submission(s) ..." % len(filenames)
+    job = functools.partial(studentJob, args, startDir, solutions)
+    pool = Prefetcher(job, startDir, filenames, len(filenames), args.jobs)
+    results = {}
+    try:
+        for filename in filenames:
+            result = pool.get(filename)
+            if result is None:
+                result = job(filename)
+            results[filename] = result
+    finally:
+        pool.close()
+        os.chdir(startDir)
+    return results
+
+
+# Worker loop for Prefetcher: job on each queued file name until None
+def prefetchWorker(job, log, tasks, results):
+    # keep the grader's terminal for the interactive prompts
+    sys.stdout = open(log, 'a', 0)
+    while True:
+        filename = tasks.get()
+        if filename is None:
+            break
+        try:
+            result = job(filename)
+        except Exception:
+            logging.exception('%s: prefetch failed', filename)
+            result = None
+        results.put((filename, result))
+
+
+# Runs job (runStudent by default) for the next few submissions in
+# background processes while the grader is busy in fillRubrics, handing
+# results back in order. Workers are plain (non-daemon) processes since
+# Difference forks its own.
+class Prefetcher(object):
+    def __init__(self, job, startDir, filenames, depth, workers=None):
+        self.depth = depth
+        self.pending = list(filenames)
+        self.outstanding = set()
+        self.done = {}
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        log = os.path.join(makeFolder(startDir, 'work'), 'prefetch.log')
+        self.workers = []
+        for i in range(workers or depth):
+            worker = multiprocessing.Process(target=prefetchWorker,
+                        args=(job, log, self.tasks, self.results))
+            worker.start()
+            self.workers.append(worker)
+        self.fill()
+
+    def submit(self, filename):
+        self.pending.remove(filename)
+        self.outstanding.add(filename)
+        self.tasks.put(filename)
+
+    # keep the current submission plus 'depth' upcoming ones in flight
+    def fill(self):
+        while self.pending and len(self.outstanding) <= self.depth:
+            self.submit(self.pending[0])
+
+    # result of job for filename, None if the worker failed
+    def get(self, filename):
+        if filename in self.pending:
+            self.submit(filename)
+        while filename not in self.done:
+            name, ok = self.results.get()
+            self.done[name] = ok
+        self.outstanding.discard(filename)
+        self.fill()
+        return self.done.pop(filename)
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join()
+
+
+# Compile every submission up front, moving the ones that fail into
+# compilerr/ before interactive grading starts
+def precompile(args, startDir, filenames, compilerrFolder):
+    print "Compiling %d submission(s) ..." % len(filenames)
+    job = functools.partial(compileStudent, args, startDir)
+    pool = Prefetcher(job, startDir, filenames, len(filenames), max(args.prefetch, 1))
+    compiled = []
+    try:
+        for filename in filenames:
+            ok = pool.get(filename)
+            if ok is None:
+                ok = job(filename)
+            if ok:
+                compiled.append(filename)
+            else:
+                print "Compile Error !!! Grade later -> %s" % filename
+                filePath = os.path.join(startDir, args.turnin, filename)
+                shelve(compilerrFolder, filePath)
+    finally:
+        pool.close()
+        os.chdir(startDir)
+    print "%d compiled, %d moved to 'compilerr'" % (len(compiled), len(filenames) - len(compiled))
+    return compiled
+
+
+# PATH lookup, None if name is not installed
+def findExecutable(name):
+    for folder in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def hashFile(h, path):
+    with open(path, 'rb') as src:
+        for block in iter(lambda: src.read(1 << 16), ''):
+            h.update(block)
+
+# Hash of everything the instructor outputs depend on: the solution, the
+# --folder files (which hold the test inputs), the test names, the output
+# cap and the java/javac installs (identified by resolved path, size and
+# mtime so no JVM has to start to ask for its version). --jvm-runner is in
+# as well since the recorded run times depend on it.
+GOLDEN = 2      # bump when the golden pickle layout changes
+
+def goldenKey(args):
+    h = hashlib.sha1()
+    files = [args.solution]
+    if args.folder:
+        files += sorted(os.path.join(args.folder, f) for f in os.listdir(args.folder))
+    for name in files:
+        if os.path.isfile(name):
+            h.update(os.path.basename(name) + '\0')
+            hashFile(h, name)
+    h.update(repr((GOLDEN, args.jvm_runner, args.input, args.output, Command.maxOutput,
+                   Command.limits, Command.xmx)))
+    for tool in ('java', 'javac'):
+        path = findExecutable(tool)
+        if path is not None:
+            path = os.path.realpath(path)
+            st = os.stat(path)
+            h.update('%s %d %d\n' % (path, st.st_size, int(st.st_mtime)))
+    return h.hexdigest()
+
+
+# Overview of every diff page of the assignment, with what each says and
+# how many students share it. Written next to diff/ rather than in it: diff/
+# is what gets published, and its folder names are what keep each
+# student's pages private.
+def writeIndex(startDir):
+    diffRoot = os.path.join(startDir, 'diff')
+    if not os.path.isdir(diffRoot):
+        return
+    pages = []
+    shared = defaultdict(int)
+    for folder in sorted(os.listdir(diffRoot)):
+        path = os.path.join(diffRoot, folder)
+        if folder == '.store' or not os.path.isdir(path):
+            continue
+        for name in sorted(os.listdir(path)):
+            st = os.stat(os.path.join(path, name))
+            shared[st.st_ino] += 1
+            pages.append((folder, name, st.st_ino))
+    summaries = {}
+    rows = []
+    for folder, name, ino in pages:
+        if ino not in summaries:
+            with open(os.path.join(diffRoot, folder, name)) as f:
+                mo = re.search(r'<p>(.*?)</p>', f.read(2048), re.S)
+            summaries[ino] = mo.group(1) if mo else cgi.escape(name)
+        rows.append('<tr><td>%s</td><td><a href="diff/%s/%s">%s</a></td><td>%s</td><td>%s</td></tr>' % (
+            folder, folder, name, name, summaries[ino],
+            'shared by %d' % shared[ino] if shared[ino] > 1 else ''))
+    with open(os.path.join(startDir, 'diff-index.html'), 'w') as out:
+        out.write(INDEX_PAGE % (len(pages), len(shared), '\n'.join(rows)))
+    print "Diff index in 'diff-index.html': %d page(s), %d stored" % (len(pages), len(shared))
+
+INDEX_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>diff index</title>
+<style>
+table {font-family: monospace; border-collapse: collapse}
+td, th {padding: 0 8px; text-align: left; vertical-align: top}
+tr:nth-child(even) {background: #f4f4f4}
+</style></head><body>
+<p>%d page(s), %d distinct</p>
+<table>
+<tr><th>folder</th><th>page</th><th>result</th><th></th></tr>
+%s
+</table></body></html>
+"""
+
+
+# Prefetcher job for autograde: the testStudent record without the outputs
+# and diff contents, to keep what goes through the result queue small
+def autogradeJob(args, startDir, solutions, filename):
+    record = testStudent(args, startDir, re.match(FPATTERN, filename), solutions)
+    return summarize(record)
+
+def summarize(record):
+    tests = []
+    for test in record['tests']:
+        tests.append({'input': test['input'], 'status': test['status'],
+                      'time': test['time'], 'timeout': test['timeout'],
+                      'passed': test.get('passed', False),
+                      'usage': test.get('usage'), 'limit': test.get('limit'),
+                      'slow': test.get('slow'),
+                      'diffs': [dest for dest, text in test['files']]})
+    return {'file': record.get('file'), 'cid': record['cid'],
+            'compiled': record['compiled'], 'compile': record['compile'],
+            'time': sum(test['time'] for test in tests), 'tests': tests}
+
+
+# Headless grading: compile/run/diff every submission in turnin on all
+# cores, the slowest first, then write autograde.json with every result
+# and autograde.csv with one line per submission
+def autograde(args):
+    assert os.path.isdir(args.turnin)
+    startDir = os.getcwd()
+    configure(args, startDir)
+    solutions = genGolden(args)
+    os.chdir(startDir)
+
+    runnable = []
+    results = []
+    for filename in sorted(os.listdir(args.turnin)):
+        match_obj = re.match(FPATTERN, filename)
+        if match_obj is not None and match_obj.group(5) == args.solution:
+            runnable.append(filename)
+        else:
+            results.append({'file': filename, 'cid': match_obj and match_obj.group(3),
+                            'compiled': False, 'compile': 'wrong file name',
+                            'time': 0.0, 'tests': []})
+
+    # run time from the last autograde if there was one, else source size;
+    # cached submissions cost nothing
+    previous = {}
+    if os.path.exists('autograde.json'):
+        with open('autograde.json') as f:
+            for result in json.load(f):
+                previous[result['file']] = result['time']
+    def cost(filename):
+        origin = os.path.join(startDir, args.turnin, filename)
+        if os.path.exists(os.path.join(startDir, 'cache', resultKey(args, origin) + '.pickle')):
+            return -1
+        if filename in previous:
+            return previous[filename] * 1e9
+        return os.path.getsize(origin)
+    order = sorted(runnable, key=cost, reverse=True)
+
+    print "Autograding %d submission(s) with %d process(es) ..." % (len(order), args.jobs)
+    job = functools.partial(autogradeJob, args, startDir, solutions)
+    pool = Prefetcher(job, startDir, order, len(order), args.jobs)
+    try:
+        for i, filename in enumerate(order):
+            result = pool.get(filename)
+            if result is None:
+                result = job(filename)
+            results.append(result)
+            passed = len([t for t in result['tests'] if t['passed']])
+            print "[%d/%d] %s: %s" % (i + 1, len(order), filename,
+                "%d/%d passed" % (passed, len(result['tests'])) if result['compiled']
+                else 'compile error')
+    finally:
+        pool.close()
+        os.chdir(startDir)
+
+    results.sort(key=lambda result: result['file'])
+    with open('autograde.json', 'w') as f:
+        json.dump(results, f, indent=1)
+    with open('autograde.csv', 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file', 'cid', 'compiled', 'time'] + list(args.input))
+        for result in results:
+            states = []
+            for test in result['tests']:
+                states.append('TIMEOUT' if test['timeout'] else 'LIMIT' if test['limit'] else
+                              'SLOW' if test.get('slow') else
+                              ('PASS' if test['passed'] else 'FAIL'))
+            writer.writerow([result['file'], result['cid'], result['compiled'],
+                             '%.2f' % result['time']] + states)
+    compiled = len([r for r in results if r['compiled']])
+    timeouts = len([r for r in results if any(t['timeout'] for t in r['tests'])])
+    allPassed = len([r for r in results if r['compiled'] and r['tests']
+                     and all(t['passed'] for t in r['tests'])])
+    slow = len([r for r in results if any(t.get('slow') for t in r['tests'])])
+    print "%d submission(s): %d compiled, %d passed every test, %d timed out, %d slow" % (
+        len(results), compiled, allPassed, timeouts, slow)
+    print "Results in 'autograde.json', summary in 'autograde.csv'"
+    writeIndex(startDir)
+    Profile.report()
+
+
+# Wall and CPU seconds of a finished run, from the stats run() filled in
+def runTime(stats):
+    usage = stats.get('usage')
+    cpu = usage and usage[0] + (usage[1] or 0)
+    return (stats['time'], cpu)
+
+# Wall-clock seconds test pos may run: --budget-factor times the
+# instructor solution's time plus --budget-slack
+def budget(args, pos):
+    return args.budget_factor * args.goldenTimes[pos][0] + args.budget_slack
+
+# How many times slower than the instructor solution a correct run of test
+# pos was, if more than --slow-factor; None otherwise. Runs under MIN_SLOW
+# seconds are never flagged, their times are mostly noise. Slower runs than
+# the budget() allows time out instead, so the budget keeps runaways short
+# and a large --budget-factor is what lets very slow runs be reported.
+MIN_SLOW = 0.25
+
+def slowdown(args, pos, time):
+    golden = args.goldenTimes[pos][0]
+    if time < MIN_SLOW or time <= args.slow_factor * golden:
+        return None
+    return time / max(golden, 0.001)
+
+# Compile solution and generate golden, or load it from solution_<a>/ when
+# nothing it depends on has changed since it was last generated. The
+# solution's run time for each test is kept with its outputs, in
+# args.goldenTimes, to size the students' time budgets.
 def genGolden(args) :
-    logging.info('running instructor solution for %d test case(s).', len(args.input))
     dirname = "solution_" + str(args.assignment)
     if not os.path.exists(dirname):
         os.makedirs(dirname)
+    args.golden = goldenKey(args)
+    cache = os.path.join(dirname, 'golden-%s.pickle' % args.golden)
+    if os.path.exists(cache) and not args.refresh_golden:
+        logging.info('using cached instructor solutions %s', cache)
+        with open(cache, 'rb') as f:
+            golden = pickle.load(f)
+        args.goldenTimes = golden['times']
+        os.chdir(dirname)
+        return golden['solutions']
+    logging.info('running instructor solution for %d test case(s).', len(args.input))
     if args.folder:
         move_required(dirname, args.folder)
     copy(dirname, args.solution)
@@ -398,52 +1939,47 @@ def genGolden(args) :
     compile(args.solution)
     classname = os.path.basename(args.solution).replace('.java', '')
     solutions = []
+    times = []
     io = map(None, args.input, args.output)
     if len(io) == 0 :
-        solutions.append(run(classname, None, None))
-    else :
-        for cur in io:
-            solutions.append(run(classname, cur[0], cur[1]))
+        io = [(None, None)]
+    for cur in io:
+        stats = {}
+        try:
+            out, expected = run(classname, cur[0], cur[1], stats, args.golden_timeout)
+        except TimeOutError:
+            sys.exit('The instructor solution timed out on test %s after %ds, see --golden-timeout'
+                     % (cur[0], args.golden_timeout))
+        solutions.append([out.getvalue(), expected])
+        times.append(runTime(stats))
+        logging.info('%s: solution took %.2fs', cur[0], stats['time'])
+    args.goldenTimes = times
     logging.info('Finished instructor solutions')
+    for old in os.listdir('.'):
+        if old.startswith('golden-') and old.endswith('.pickle'):
+            os.remove(old)
+    cache = os.path.basename(cache)
+    with open(cache + '.tmp', 'wb') as f:
+        pickle.dump({'solutions': solutions, 'times': times}, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(cache + '.tmp', cache)
     return solutions
 
 
-# Build a dictionary of ID -> Name
+# Roster of the Canvas CSV, looked up by Canvas ID
 def genInfos(args): 
-    infos = {}
-     # Hard coded values for location of information in canvas csv
-    NAME = 0
-    ID = 1
-    UTEID = 2
-    UNIQUE = 4
-    SCORE = 8
-    pattern = r'([\w\s]*)\(([\d]*)\)'
-    
-    f = open(args.info)
-    try: 
-        reader = csv.reader(f)
-        reader.next()
-        reader.next() ## skip the first two lines
-        for line in reader:
-            infos[line[ID]] = {}
-            infos[line[ID]]['name'] = line[NAME]
-            infos[line[ID]]['uteid'] = line[UTEID]
-            mo = re.match(pattern, line[UNIQUE])
-            if mo is not None: 
-                infos[line[ID]]['unique'] = mo.group(2)
-            else :
-                infos[line[ID]]['unique'] = "Unknown" 
-    finally: 
-        f.close()
-    return infos
-
-
-# read in rubrics lines 
+    return Roster.load(args.info)
+
+
+# a fresh rubric for one student
 def getRubrics(args) :
+    return rubrics(RubricTemplate.load(args.rubric))
+
+# [(key word, rubricLine)] of a rubric file
+def parseRubric(path) :
     rpattern = r'([-\d\s]*)\|([\w\s-]*)\|([\w\s-]*)'
     keyWord = ""
-    rb = rubrics()
-    for line in open(args.rubric):
+    lines = []
+    for line in open(path):
         match_obj = re.match(rpattern, line)
         if match_obj is None :
             if (isKeyWord(line)) :
@@ -462,26 +1998,47 @@ def getRubrics(args) :
             studentProp = match_obj.group(3).rstrip()
             rl = rubricLine(fullCredit, graderProp, studentProp)
             # rl.getStudentScore()
-            rb.addRubric(rl, keyWord)
-    return rb
+            lines.append((keyWord, rl))
+    return lines
 
 
 # get student feedback from command line
-def fillRubrics(rb, file) :
+# passed - the submission passed every test, so correctness starts at full
+# credit and the grader only has to confirm it
+# cluster - the submission's Cluster; correctness starts from the scores
+# given to an earlier member, and what is given here is kept for the next
+def fillRubrics(rb, file, passed=False, cluster=None) :
     kws = rb.getAllKw()
     for kw in kws :
         if kw == 'style' :
             os.system('%s %s' % ('more ', file))
         print "\n" * 3
-        line = raw_input("'n' to skip  \t %s?" % kw.upper())
+        if kw == 'correctness' and passed :
+            for i in rb.template.byKw[kw] :
+                rb.row[i] = rb.template.lines[i].fc
+            line = ask("All tests passed, full credit. 'c' to change \t %s?" % kw.upper())
+            if len(line) == 0 or line[0].lower() != 'c' :
+                continue
+        elif kw == 'correctness' and cluster is not None and cluster.scores is not None :
+            for i in rb.template.byKw[kw] :
+                rb.row[i] = cluster.scores.get(i, rb.template.lines[i].fc)
+            line = ask("Same test results as %d other submission(s), %s as graded before. 'c' to change \t %s?"
+                       % (len(cluster.members) - 1, rb.printKWScore(kw), kw.upper()))
+            if len(line) == 0 or line[0].lower() != 'c' :
+                continue
+        else :
+            line = ask("'n' to skip  \t %s?" % kw.upper())
         if len(line) > 0 and (line[0] == 'n' or line[0] == 'N') :
             continue
         else :  
-            for rl in rb.dicts[kw] :
-                rl.getStudentScore()
+            for i in rb.template.byKw[kw] :
+                rb.row[i] = rb.template.lines[i].getStudentScore()
+    if cluster is not None and 'correctness' in rb.template.byKw :
+        cluster.scores = dict((i, rb.row[i]) for i in rb.template.byKw['correctness'])
 
 
-def getComment(root, mat_obj, scores, slips, infos, args):
+def getComment(root, mat_obj, scores, slips, infos, args, gradebook=None, matrix=None,
+               passed=False, cluster=None):
     filename = mat_obj.group(0)
     lastName = mat_obj.group(1)
     firstName = mat_obj.group(2)
@@ -489,7 +2046,8 @@ def getComment(root, mat_obj, scores, slips, infos, args):
     fid = mat_obj.group(4)
     htmlName = id2Str(int(fid))
     origin = os.path.join(root, filename)
-    print "Grading: " + infos[cid]['name']
+    Profile.tags = {'cid': cid}
+    print "Grading: " + infos.name(cid)
 
     # skip slip day, update slip day using canvas
     ''' 
@@ -500,8 +2058,8 @@ def getComment(root, mat_obj, scores, slips, infos, args):
 
     rb = getRubrics(args)
     while True : 
-        fillRubrics(rb, origin) 
-        regrade = raw_input('\'m\' for manual, \'a\' for auto, enter to continue \t Regrade?')
+        fillRubrics(rb, origin, passed, cluster)
+        regrade = ask('\'m\' for manual, \'a\' for auto, enter to continue \t Regrade?')
         if len(regrade) == 0 :
             break
         elif regrade[0].lower() == 'm' :
@@ -521,8 +2079,8 @@ def getComment(root, mat_obj, scores, slips, infos, args):
     pr.addLine("")
     pr.addLine("Submitted File: %s" % args.solution)
     pr.addLine("Name: %s %s" % (firstName.upper(), lastName.upper()))
-    pr.addLine("UT EID: %s" % infos[cid]['uteid'])
-    pr.addLine("Section 5 digit ID: %s" % infos[cid]['unique'] )
+    pr.addLine("UT EID: %s" % infos.eid(cid))
+    pr.addLine("Section 5 digit ID: %s" % infos.unique(cid))
     pr.addLine("Grader Name: %s" % args.grader)
     pr.addLine("")
     # pr.addLine("Slipday for this assignment: %d" % slip)
@@ -530,6 +2088,10 @@ def getComment(root, mat_obj, scores, slips, infos, args):
     pr.addLine("")
     
     scores[cid] = rb.getTotal(True)   # get total score for student
+    if matrix is not None:
+        matrix.add(cid, rb.row)
+    if gradebook is not None:
+        gradebook.record(args.assignment, cid, scores[cid], slips.get(cid), rb)
 
     if (rb.isFullCredit()) :
         pr.addLine("Well done!")
@@ -545,7 +2107,7 @@ def getComment(root, mat_obj, scores, slips, infos, args):
                 pr.addLine(str(line))
             pr.addLine("")
 
-    otherComment = raw_input('Other comments to student:')
+    otherComment = ask('Other comments to student:')
     if len(otherComment) > 0 :
         pr.addLine("")
         pr.addLine(otherComment)
@@ -575,52 +2137,99 @@ def isKeyWord(line):
         return True
     return False
 
-# Output the new grades into 'updated_grades.csv'
+# Output the new grades into the Canvas CSV 'info', using '.info' (the
+# copy made when grading started) as the base
 def update_grades(info, scores, slips, assignment):    
-    csid = 0  
-    scoreIndex = 0
-    slipIndex = 0
-    
-    f = open('.' + info)   # base file for the format
-    reader = csv.reader(f)
-    studentData = reader.next()
-    outFile = open(info, 'wb')
-    writer = csv.writer(outFile, delimiter = ',', quotechar = '"', quoting = csv.QUOTE_MINIMAL)
-    writer.writerow(studentData)
-
-    for i in xrange(0, len(studentData)):
-        if "Assignment "+ str(assignment) + " " in studentData[i]:
-            scoreIndex = i  
-        elif "Slip Days (" in studentData[i]:
-            slipIndex = i 
-        elif "ID" == studentData[i] : 
-            csid = i
-    
-    studentData = reader.next()     #skip second line
-    writer.writerow(studentData)
-    studentData = reader.next()     #skip third line
-    writer.writerow(studentData)
-
-    for studentData in reader:
-        id = studentData[csid]
-        if id in scores:
-            studentData[scoreIndex] = str(scores[id])
-        if id in slips:
-            slipInfo = studentData[slipIndex]
-            if len(slipInfo) > 0 and slipInfo[0].isdigit():
-                current = int(slipInfo)
-            else:
-                current = 0
-            total = slips[id] + current
-            studentData[slipIndex] = str(total)
-            if total > 6:
-                print "MAX slip day reached, current: " + str(total)   
-            #if current != 0:
-                #print studentData[slipIndex]  
-        writer.writerow(studentData)
+    roster = Roster.load('.' + info)
+    scoreIndex = roster.column("Assignment "+ str(assignment) + " ", default=0)
+    slipIndex = roster.column("Slip Days (", default=0)
+
+    newSlips = {}
+    for id in slips:
+        if id not in roster:
+            continue
+        slipInfo = roster.value(id, slipIndex)
+        if len(slipInfo) > 0 and slipInfo[0].isdigit():
+            current = int(slipInfo)
+        else:
+            current = 0
+        total = slips[id] + current
+        newSlips[id] = total
+        if total > 6:
+            print "MAX slip day reached, current: " + str(total)   
+    roster.write(info, {scoreIndex: scores, slipIndex: newSlips})
+
+
+# Local gradebook holding the session's grades keyed by Canvas ID, so each
+# graded student is one small committed write instead of a CSV rewrite.
+# export() produces the Canvas CSV through update_grades.
+class Gradebook(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS grades (
+                assignment INTEGER, cid TEXT, score INTEGER, slip INTEGER,
+                PRIMARY KEY (assignment, cid));
+            CREATE TABLE IF NOT EXISTS rubric (
+                assignment INTEGER, cid TEXT, line INTEGER, keyword TEXT,
+                score INTEGER, full INTEGER,
+                PRIMARY KEY (assignment, cid, line));
+        ''')
+
+    # store a student's total, slip days (None if not set) and rubric lines
+    def record(self, assignment, cid, score, slip, rb):
+        template = rb.template
+        lines = []
+        for i, rl in enumerate(template.lines):
+            lines.append((assignment, cid, i, template.keywords[i], rb.row[i], rl.fc))
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO grades VALUES (?, ?, ?, ?)',
+                            (assignment, cid, score, slip))
+            self.db.execute('DELETE FROM rubric WHERE assignment = ? AND cid = ?',
+                            (assignment, cid))
+            self.db.executemany('INSERT INTO rubric VALUES (?, ?, ?, ?, ?, ?)', lines)
+
+    def scores(self, assignment):
+        rows = self.db.execute('SELECT cid, score FROM grades WHERE assignment = ?',
+                               (assignment,))
+        return dict(rows)
+
+    def slips(self, assignment):
+        rows = self.db.execute('SELECT cid, slip FROM grades WHERE assignment = ?'
+                               ' AND slip IS NOT NULL', (assignment,))
+        return dict(rows)
+
+    # ScoreMatrix of the recorded rubric lines. Rows keep each line's
+    # deduction and are laid out by the template the rubric was graded with,
+    # rebuilt here from the stored key words and full credits.
+    def matrix(self, assignment):
+        rows = defaultdict(list)
+        for cid, keyword, score, full in self.db.execute(
+                'SELECT cid, keyword, score, full FROM rubric WHERE assignment = ?'
+                ' ORDER BY cid, line', (assignment,)):
+            rows[cid].append((keyword, score, full))
+        layout = None
+        matrix = None
+        for cid, lines in rows.items():
+            key = [(kw, full) for kw, score, full in lines]
+            if key != layout:
+                if layout is not None:
+                    logging.warning('rubric layout changed during grading, %s kept as graded', cid)
+                    continue
+                layout = key
+                # only the key words and full credits matter for rescoring
+                template = RubricTemplate([(kw, rubricLine(full, '', '')) for kw, full in key])
+                matrix = ScoreMatrix(template)
+            matrix.add(cid, [score for kw, score, full in lines])
+        return matrix
+
+    # write every recorded grade into the Canvas CSV
+    def export(self, info, assignment):
+        with span('update_grades'):
+            update_grades(info, self.scores(assignment), self.slips(assignment), assignment)
 
-    f.close()
-    outFile.close()
+    def close(self):
+        self.db.close()
 
 
 def id2Str(num) :
@@ -641,7 +2250,7 @@ def getAn(num) :
 
 def get_Int(prop, minV, maxV, deV):
     while True:
-        inStr = raw_input(prop)
+        inStr = ask(prop)
         if len(inStr) == 0:
             return deV
         else :
@@ -657,10 +2266,16 @@ def get_Int(prop, minV, maxV, deV):
                 else:
                     return (intTarget)
 
+# root/name, made if missing. Parallel workers may race to make the same
+# folder (cache/, diff/.store), so one that already exists is fine.
 def makeFolder(root, name) :
     folder = os.path.join(root, name)
     if not os.path.exists(folder):
-        os.makedirs(folder)  
+        try:
+            os.makedirs(folder)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
     return folder
 
 
@@ -672,60 +2287,388 @@ def finish(args) :
     print r"1. check 'compilerr' for files with compile error"
     print r"2. check 'wrongName' for files with incorrect name"
     print r"3. check 'regrade' for files to manual regrade"
+    Profile.report()
     print "done"
 
 
-def main(args):
-    assert os.path.isdir(args.turnin)
+# Rendered pages, least recently used first
+class PageCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            page = self.pages.pop(key, None)
+            if page is not None:
+                self.pages[key] = page
+            return page
+
+    def put(self, key, page):
+        with self.lock:
+            self.pages.pop(key, None)
+            self.pages[key] = page
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+
+# Diffs of the outputs saved in work/<cid>/ against the golden solutions,
+# rendered when a page is first asked for. After each page the same test of
+# the next student is rendered in the background, so paging through the
+# class doesn't wait on the diff.
+class DiffViewer(object):
+    CACHE = 200         # rendered pages kept
+
+    def __init__(self, args, startDir, solutions):
+        self.startDir = startDir
+        self.solutions = solutions
+        self.tests = map(None, args.input, args.output) or [(None, None)]
+        self.classname = os.path.basename(args.solution).replace('.java', '')
+        self.names = {}
+        info = args.info and ('.' + args.info if os.path.exists('.' + args.info) else args.info)
+        if info and os.path.exists(info):
+            roster = Roster.load(info)
+            self.names = dict(zip(roster.cids, roster.names))
+        workDir = os.path.join(startDir, 'work')
+        self.cids = sorted(cid for cid in os.listdir(workDir)
+                           if os.path.isdir(os.path.join(workDir, cid))) if os.path.isdir(workDir) else []
+        self.digests = [(outputHash(out), expected and outputHash(expected))
+                        for out, expected in solutions]
+        self.pages = PageCache(self.CACHE)
+        self.status = {}
+        self.render = threading.Lock()      # one diff worker per process
+        self.ahead = Queue()
+        worker = Thread(target=self.renderAhead)
+        worker.daemon = True
+        worker.start()
+
+    # saved output of test i for cid, and the matching solution text
+    def files(self, cid, i):
+        inputName, outputName = self.tests[i]
+        folder = os.path.join(self.startDir, 'work', cid)
+        yield os.path.join(folder, (inputName or self.classname) + '.stdout'), self.solutions[i][0], self.digests[i][0]
+        if outputName:
+            yield os.path.join(folder, outputName), self.solutions[i][1], self.digests[i][1]
+
+    def stamp(self, path):
+        st = os.stat(path)
+        return (path, st.st_mtime, st.st_size)
+
+    # summary of cid's latest run (saveState), None for work dirs from
+    # before it was kept
+    def state(self, cid):
+        path = os.path.join(self.startDir, 'work', cid, STATE)
+        if not os.path.exists(path):
+            return None
+        key = self.stamp(path)
+        if key not in self.status:
+            with open(path) as f:
+                self.status[key] = json.load(f)
+        return self.status[key]
+
+    # 'pass', 'differs', 'timeout', 'limit', 'uncompiled' or 'missing' for
+    # test i of cid
+    def result(self, cid, i):
+        summary = self.state(cid)
+        if summary is not None:
+            if not summary['compiled']:
+                return 'uncompiled'
+            if i >= len(summary['tests']):
+                return 'missing'
+            if summary['tests'][i]['timeout']:
+                return 'timeout'
+            if summary['tests'][i]['limit']:
+                return 'limit'
+        state = 'pass'
+        for path, solution, digest in self.files(cid, i):
+            if not os.path.exists(path):
+                return 'missing'
+            key = self.stamp(path)
+            if key not in self.status:
+                self.status[key] = outputHash(OutputBuffer.saved(path)) == digest
+            if not self.status[key]:
+                state = 'differs'
+        return state
+
+    def page(self, cid, i, whitespace):
+        parts = []
+        for path, solution, digest in self.files(cid, i):
+            if not os.path.exists(path):
+                parts.append('<p>No saved output in %s</p>' % cgi.escape(path))
+                continue
+            key = (self.stamp(path), whitespace)
+            html = self.pages.get(key)
+            if html is None:
+                with self.render:
+                    html = Difference(solution, OutputBuffer.saved(path), '', whitespace).run(timeout=15)
+                self.pages.put(key, html)
+            parts.append(html)
+        return parts
+
+    def renderAhead(self):
+        while True:
+            cid, i, whitespace = self.ahead.get()
+            try:
+                self.page(cid, i, whitespace)
+            except Exception:
+                logging.exception('rendering %s ahead failed', cid)
+
+    def name(self, cid):
+        return self.names.get(cid, '')
+
+    def index(self):
+        rows = []
+        for cid in self.cids:
+            cells = []
+            for i, (inputName, outputName) in enumerate(self.tests):
+                state = self.result(cid, i)
+                cells.append('<td class="%s"><a href="/diff/%s/%d">%s</a></td>' % (
+                    state, quote(cid), i, state))
+            rows.append('<tr><td>%s</td><td>%s</td>%s</tr>' % (
+                cgi.escape(cid), cgi.escape(self.name(cid)), ''.join(cells)))
+        head = ''.join('<th>%s</th>' % cgi.escape(str(t[0])) for t in self.tests)
+        return VIEWER_INDEX % (len(self.cids), head, '\n'.join(rows))
+
+    def diffPage(self, cid, i, whitespace):
+        n = self.cids.index(cid)
+        links = []
+        if n > 0:
+            links.append('<a href="/diff/%s/%d?ws=%s">&larr; %s</a>' % (
+                quote(self.cids[n - 1]), i, whitespace, cgi.escape(self.cids[n - 1])))
+        links.append('<a href="/">index</a>')
+        if n + 1 < len(self.cids):
+            links.append('<a href="/diff/%s/%d?ws=%s">%s &rarr;</a>' % (
+                quote(self.cids[n + 1]), i, whitespace, cgi.escape(self.cids[n + 1])))
+            self.ahead.put((self.cids[n + 1], i, whitespace))
+        for j, (inputName, outputName) in enumerate(self.tests):
+            links.append('<a href="/diff/%s/%d?ws=%s">%s</a>' % (
+                quote(cid), j, whitespace, '<b>%s</b>' % inputName if j == i else inputName))
+        for mode in sorted(WHITESPACE):
+            links.append('<a href="/diff/%s/%d?ws=%s">%s</a>' % (
+                quote(cid), i, mode, '<b>%s</b>' % mode if mode == whitespace else mode))
+        nav = '<p>%s %s &middot; %s</p>' % (cgi.escape(cid), cgi.escape(self.name(cid)),
+                                             ' &middot; '.join(links))
+        return '\n'.join(part.replace('<body>', '<body>' + nav, 1) if '<body>' in part
+                         else nav + part for part in self.page(cid, i, whitespace))
+
+VIEWER_INDEX = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>diffs</title>
+<style>
+table {font-family: monospace; border-collapse: collapse}
+td, th {padding: 0 8px; text-align: left}
+td.pass a {color: #080} td.differs a, td.timeout a, td.limit a {color: #c00}
+td.missing a, td.uncompiled a {color: #999}
+</style></head><body>
+<p>%d student(s)</p>
+<table>
+<tr><th>cid</th><th>name</th>%s</tr>
+%s
+</table></body></html>
+"""
+
+class ViewerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    viewer = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [unquote(p) for p in url.path.split('/') if p]
+        whitespace = parse_qs(url.query).get('ws', ['rstrip'])[0]
+        try:
+            if not parts:
+                self.reply(200, self.viewer.index())
+            elif (len(parts) == 3 and parts[0] == 'diff' and parts[1] in self.viewer.cids
+                    and parts[2].isdigit() and int(parts[2]) < len(self.viewer.tests)
+                    and whitespace in WHITESPACE):
+                self.reply(200, self.viewer.diffPage(parts[1], int(parts[2]), whitespace))
+            else:
+                self.reply(404, '<p>Not found</p>')
+        except Exception:
+            logging.exception('serving %s', self.path)
+            self.reply(500, '<p>Error, see the grading terminal</p>')
+
+    def reply(self, code, html):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(html)))
+        self.end_headers()
+        self.wfile.write(html)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+# Browse every saved output against the golden on http://localhost:port
+def serve(args):
     startDir = os.getcwd()
+    configure(args, startDir)
+    solutions = genGolden(args)
+    os.chdir(startDir)
+    ViewerHandler.viewer = DiffViewer(args, startDir, solutions)
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', args.port), ViewerHandler)
+    url = 'http://localhost:%d/' % server.server_address[1]
+    print "Serving %d student(s) on %s, Ctrl-C to stop" % (len(ViewerHandler.viewer.cids), url)
+    if args.webbrowser:
+        webbrowser.open_new_tab(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
+
+# session-wide settings shared by every mode
+def configure(args, startDir):
     if len(args.input) > 0 and len(args.output) > 0:
         assert len(args.input) == len(args.output)
+    if args.profile:
+        Profile.start(args.profile)
+    Command.maxOutput = args.max_output
+    Command.pacing = args.pacing
+    Command.limits = rlimits(args)
+    Command.xmx = args.xmx
+    if args.slow_factor >= args.budget_factor:
+        logging.warning('--slow-factor %g is not below --budget-factor %g, slow runs will '
+                        'time out instead of being flagged', args.slow_factor, args.budget_factor)
+    if args.folder:
+        Support.build(os.path.join(startDir, '.support'), args.folder)
+    if args.jvm_runner:
+        JavaRunner.build(os.path.join(startDir, '.runner'))
+
+
+# Recompute every recorded grade of the assignment with the current rubric
+# file, keeping each line's deduction, and export them to the Canvas CSV
+def rescore(args):
+    startDir = os.getcwd()
+    gradebook = Gradebook(os.path.join(startDir, 'gradebook.sqlite'))
+    try:
+        graded = gradebook.matrix(args.assignment)
+        if graded is None:
+            print "Nothing graded for assignment %d yet" % args.assignment
+            return
+        matrix = graded.rescore(RubricTemplate.load(args.rubric))
+        before = graded.totals()
+        after = matrix.totals()
+        slips = gradebook.slips(args.assignment)
+        changed = 0
+        for cid, row in matrix.rows.items():
+            gradebook.record(args.assignment, cid, after[cid], slips.get(cid),
+                             rubrics(matrix.template, row))
+            if after[cid] != before[cid]:
+                changed += 1
+        print "Rescored %d student(s), %d total(s) changed" % (len(after), changed)
+        matrix.report()
+        backup(startDir, args.info)
+        gradebook.export(args.info, args.assignment)
+        print "Grade have been updated in \'%s\'" % args.info
+    finally:
+        gradebook.close()
+
+
+def main(args):
+    if args.mode == 'autograde':
+        return autograde(args)
+    if args.mode == 'rescore':
+        return rescore(args)
+    if args.mode == 'serve':
+        return serve(args)
+    assert os.path.isdir(args.turnin)
+    startDir = os.getcwd()
+
+    configure(args, startDir)
     solutions = genGolden(args)
 
-    feedbackFolder = makeFolder(startDir, 'feedback')
-    compilerrFolder = makeFolder(startDir, 'compilerr')
-    wrongNameFolder = makeFolder(startDir, 'wrongName')
-    regradeFolder = makeFolder(startDir, 'regrade')
-    gradedFolder = makeFolder(startDir, 'graded')
+    feedbackFolder, compilerrFolder, wrongNameFolder, regradeFolder, gradedFolder = \
+        staging.folders(startDir, ['feedback', 'compilerr', 'wrongName', 'regrade', 'graded'])
 
     os.chdir(startDir)
     scores = {}
     slips = {}
+    gradebook = Gradebook(os.path.join(startDir, 'gradebook.sqlite'))
+    matrix = ScoreMatrix(RubricTemplate.load(args.rubric))
     infos = genInfos(args)
-    move(startDir, args.info, '.' + args.info)
-    
-    #             lastN    firstN   cId     fid     fName
-    fpattern = r'([\w-]*)--([\w-]*)_([\d]*)_([\d]*)_([\w]*.java)'
-    for filename in os.listdir(args.turnin):
-        filePath = os.path.join(startDir, args.turnin, filename)
-        stop = raw_input("\n\n\nnext student('done' to stop) ?")
-        if 'done' in stop :
-            break
-        match_obj = re.match(fpattern, filename)
-        if match_obj is None :
-            print "Filename syntex error: ", filename
-            continue
-        elif match_obj.group(5) != args.solution :
-            print "Wrong file name !!! Grade later -> %s\n" % filename
-            copy(wrongNameFolder, filePath)
-            os.system('%s %s' % ('rm ', filePath))
-            continue 
-        if not runStudent(args, startDir, match_obj, solutions) :
-            print "\nCompile Error !!! Grade later -> %s\n" % filename
-            copy(compilerrFolder, filePath)
-            os.system('%s %s' % ('rm ', filePath))
-            continue
-
-        copy(feedbackFolder, filePath)
+    backup(startDir, args.info)
+
+    filenames = os.listdir(args.turnin)
+    runnable = []
+    for filename in filenames:
+        match_obj = re.match(FPATTERN, filename)
+        if match_obj is not None and match_obj.group(5) == args.solution:
+            runnable.append(filename)
+    if args.precompile:
+        compiled = precompile(args, startDir, runnable, compilerrFolder)
+        filenames = [f for f in filenames if f in compiled or f not in runnable]
+        runnable = compiled
+    clusters = {}       # fingerprint -> Cluster
+    results = {}
+    if args.cluster:
+        # grade each group of identical results back to back, biggest first
+        results = runAll(args, startDir, solutions, runnable)
+        for filename in runnable:
+            key = results[filename][2]
+            # submissions without a fingerprint are groups of their own
+            clusters.setdefault(filename if key is None else key, Cluster()).members.append(filename)
+        groups = sorted(clusters.values(), key=lambda c: -len(c.members))
+        filenames = [f for f in filenames if f not in results] + \
+                    [f for c in groups for f in c.members]
+        print "%d submission(s) in %d group(s) of identical test results, largest %d" % (
+            len(runnable), len(groups), len(groups[0].members) if groups else 0)
+    prefetcher = None
+    if args.prefetch > 0 and not args.cluster:
+        job = functools.partial(studentJob, args, startDir, solutions)
+        prefetcher = Prefetcher(job, startDir, runnable, args.prefetch)
+    try:
+        for filename in filenames:
+            filePath = os.path.join(startDir, args.turnin, filename)
+            Profile.tags = {}
+            stop = ask("\n\n\nnext student('done' to stop) ?")
+            if 'done' in stop :
+                break
+            match_obj = re.match(FPATTERN, filename)
+            if match_obj is None :
+                print "Filename syntex error: ", filename
+                continue
+            elif match_obj.group(5) != args.solution :
+                print "Wrong file name !!! Grade later -> %s\n" % filename
+                shelve(wrongNameFolder, filePath)
+                continue 
+            with span('prefetch wait', cid=match_obj.group(3)):
+                result = prefetcher.get(filename) if prefetcher else results.get(filename)
+            if result is None:
+                result = studentJob(args, startDir, solutions, filename)
+            ok, passed, key, pages = result
+            if args.webbrowser:
+                for page in pages:
+                    webbrowser.open_new_tab("file://" + page)
+            cluster = None
+            if args.cluster and key is not None:
+                cluster = clusters.setdefault(key, Cluster())
+                if filename not in cluster.members:
+                    cluster.members.append(filename)
+            if not ok :
+                print "\nCompile Error !!! Grade later -> %s\n" % filename
+                shelve(compilerrFolder, filePath)
+                continue
+
+            copy(feedbackFolder, filePath)
+            os.chdir(startDir)
+            with span('getComment', cid=match_obj.group(3)):
+                graded = getComment(feedbackFolder, match_obj, scores, slips, infos, args,
+                                    gradebook, matrix, passed, cluster)
+            if not graded:
+                copy(regradeFolder, os.path.join(startDir, args.turnin, filename))
+                continue
+            shelve(gradedFolder, filePath)
+    finally:
+        if prefetcher:
+            prefetcher.close()
         os.chdir(startDir)
-        if not getComment(feedbackFolder, match_obj, scores, slips, infos, args):
-            copy(regradeFolder, os.path.join(startDir, args.turnin, filename))
-            continue
-        update_grades(args.info, scores, slips, args.assignment)
-        copy(gradedFolder, filePath)
-        os.system('%s %s' % ('rm ', filePath))
-    finish()
+        gradebook.export(args.info, args.assignment)
+        gradebook.close()
+    writeIndex(startDir)
+    matrix.report()
+    finish(args)
         
 
 if __name__ == '__main__':
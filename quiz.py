@@ -1,8 +1,11 @@
 import os
 import argparse
-import csv
 import sys
 import re
+import bisect
+
+from roster import Roster
+import staging
 
 # set up command-line arguments
 FLAGS = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -10,60 +13,106 @@ A = FLAGS.add_argument
 A('-c', '--columnName', type = str, help = 'Column Name, such as \'Quiz 1 (3294843)\'')
 A('-m', '--maxV', type = int, help = 'Maxmun score allowed, such as \'10\' for Quiz')
 A('-i', '--info', metavar = 'FILE', help = 'CSV file containing student information')
+A('-f', '--flush', type = int, default = 20, help = 'Rewrite the CSV every N scores, 0 to write only on \'done\'')
+
+
+# Scores are appended to a fsync'd journal as they are entered and only
+# written into the CSV every 'flush' entries (and on 'done'). A journal
+# left behind by a crashed session is replayed on the next start. Each
+# entry carries the title of its column, and a journal for another column
+# is refused rather than replayed into this one.
+class ScoreLog(object):
+    def __init__(self, scores, roster, score, args):
+        self.scores = scores
+        self.roster = roster
+        self.score = score
+        self.title = roster.head[0][score]
+        self.args = args
+        self.path = '.' + args.info + '.journal'
+        self.pending = 0
+        self.replay()
+        self.journal = open(self.path, 'a')
+
+    def replay(self):
+        if not os.path.exists(self.path):
+            return
+        entries = []
+        with open(self.path) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break   # torn last write
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 3 or fields[0] != self.title:
+                    title = fields[0] if len(fields) == 3 else 'an unknown column'
+                    sys.exit('>> %s holds unsaved scores for "%s", not "%s". Run with -c for '
+                             'that column to recover them, or remove it.' % (self.path, title, self.title))
+                entries.append((fields[1], int(fields[2])))
+        for cid, score in entries:
+            self.scores[cid] = score
+        count = len(entries)
+        if count > 0:
+            print '>> Recovered', count, 'unsaved score(s) from', self.path
+            write(self.scores, self.roster, self.score, self.args)
+        os.remove(self.path)
+
+    def add(self, cid, score):
+        self.journal.write('%s\t%s\t%d\n' % (self.title, cid, score))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.pending += 1
+        if self.args.flush > 0 and self.pending >= self.args.flush:
+            self.flush()
+
+    # write all scores to the CSV and start a new journal
+    def flush(self):
+        if self.pending > 0:
+            write(self.scores, self.roster, self.score, self.args)
+            self.journal.truncate(0)
+            os.fsync(self.journal.fileno())
+            self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.journal.close()
+        os.remove(self.path)
 
 def main(args):
-    f = open(args.info)
-    
-    # column index ...
-    index = {}
-    index['name'] = 0   # column index for 'Name', change it base on the CSV file
-    index['cid'] = 1
-    index['eid'] = 2
-    index['score'] = 8   # updated based on 'columnName' 
- 
-    names = {}
-    eids = {}
+    roster = Roster.load(args.info)
+    score = roster.column(args.columnName, default=8)
+    print '>> Taget column: ', roster.head[0][score]
+
+    names = dict(zip(roster.cids, roster.names))    # cid -> name
+    eids = dict(zip(roster.eids, roster.cids))      # eid -> cid
     scores = {}
     noScore = 0
-    total = 0
-    try: 
-        reader = csv.reader(f)
-        data = reader.next()
-        for i in xrange(0, len(data)):
-            if args.columnName in data[i]:
-                index['score'] = i
-                print '>> Taget column: ', data[i]
-
-        reader.next() ## skip the second line
-        for line in reader:
-            names[line[index['cid']]] = line[index['name']]   # cid -> name 
-            eids[line[index['eid']]] = line[index['cid']]     # eid -> cid
-            total += 1
-            if len(line[index['score']]) == 0:
-                noScore += 1
-            else :
-                scores[line[index['cid']]] = line[index['score']]	
-    finally: 
-        f.close()
+    total = len(roster)
+    for cid, value in zip(roster.cids, roster.columns[score]):
+        if len(value) == 0:
+            noScore += 1
+        else :
+            scores[cid] = value
     print ">> Total:", total, ", where", noScore, "has no score yet."  
+    finder = FuzzyIndex(eids, names)
     
-    os.system('%s %s %s' % ('cp', args.info, '.' + args.info))
+    staging.copy(args.info, '.' + args.info)
+    log = ScoreLog(scores, roster, score, args)
 
     while (True) :
     	uteid = raw_input(">> input student ut eid (\'done\' to stop): ")
         if (uteid.lower() == "done") :
-            print '>> Thanks for using! Scores saved to \"', args.output, '\"\n'
+            log.close()
+            print '>> Thanks for using! Scores saved to \"', args.info, '\"\n'
             break
         if uteid in eids :
-            updateScore(uteid, eids, names, scores, index, args)
+            updateScore(uteid, eids, names, scores, args, log)
         else:
-            similarID = vagueSearch(eids, uteid)
+            similarID = vagueSearch(finder, uteid)
             if len(similarID) == 0 :
                 print ">> Student ", uteid, "is not found, give up"
             elif len(similarID) == 1:
                 confirm = raw_input(">> No student found for " + uteid + ", do you mean " + similarID[0] + " ('N' for No): ")
                 if len(confirm) == 0 or (confirm[0] != 'n' and confirm[0] != 'N'): 
-                    updateScore(similarID[0], eids, names, scores, index, args)
+                    updateScore(similarID[0], eids, names, scores, args, log)
             else :
                 print ">> Do you mean the following student(s): "
                 for i in xrange(0, len(similarID)):
@@ -71,10 +120,10 @@ def main(args):
                     print ">> [", i + 1, "]  EID: ", item, " Name: ", names[eids[item]]
                 choice = get_Int(">> Make a choice, 0 to skip: ", 0, len(similarID))
                 if choice > 0:
-                    updateScore(similarID[choice - 1], eids, names, scores, index, args)
+                    updateScore(similarID[choice - 1], eids, names, scores, args, log)
         print ''
 
-def updateScore(uteid, eids, names, scores, index, args):
+def updateScore(uteid, eids, names, scores, args, log):
     cvid = eids[uteid]
     score = get_Int(">> input score for " + names[cvid] + '(' + uteid + "): ", 0, args.maxV)
     if cvid not in scores :
@@ -83,54 +132,88 @@ def updateScore(uteid, eids, names, scores, index, args):
     else :
         print ">> Score already exists for", names[cvid] , '(', uteid, ') @ ' + str(scores[cvid]), ' updated to ', str(score)
         scores[cvid] = score
-    write(scores, index, args)   # update output on each modification of score
-
-
-
-# in case of typo... 3 can be changed to other edit distance
-def vagueSearch(eids, uteid):
-    similarID = []
-    for eid in eids :
-        if minDistance(uteid, eid) < 3 :
-            similarID.append(eid)
-    return similarID
-
-# get edit distance for two strings (ut eid here)
-def minDistance(word1, word2):
+    log.add(cvid, score)   # journaled now, written to the CSV in batches
+
+
+
+# in case of typo... closest EIDs first, then EIDs whose name starts with it
+def vagueSearch(finder, uteid):
+    return finder.search(uteid)
+
+
+# Fuzzy EID lookup built once per roster. Two strings within 'limit' edits
+# always share a string reachable from both by at most 'limit' deletions,
+# so every EID is indexed under its deletion variants and a lookup only
+# checks the EIDs sharing a variant with the query. A sorted list of name
+# words gives the prefix matches.
+class FuzzyIndex(object):
+    def __init__(self, eids, names, limit = 2):
+        self.limit = limit
+        self.variants = {}
+        for eid in eids:
+            for variant in deletions(eid, limit):
+                self.variants.setdefault(variant, []).append(eid)
+        words = set()
+        for eid in eids:
+            name = names[eids[eid]].lower()
+            words.add((name, eid))
+            for word in re.split(r'[\s,]+', name):
+                if word:
+                    words.add((word, eid))
+        self.words = sorted(words)
+
+    # EIDs within limit edits of uteid ranked by distance, then EIDs of
+    # students with a name (or a word of it) starting with uteid
+    def search(self, uteid):
+        candidates = set()
+        for variant in deletions(uteid, self.limit):
+            candidates.update(self.variants.get(variant, ()))
+        found = []
+        for eid in candidates:
+            distance = boundedDistance(uteid, eid, self.limit)
+            if distance <= self.limit:
+                found.append((distance, eid))
+        found.sort()
+        similarID = [eid for d, eid in found]
+        prefix = uteid.lower()
+        if len(prefix) >= 2:
+            i = bisect.bisect_left(self.words, (prefix, ''))
+            while i < len(self.words) and self.words[i][0].startswith(prefix):
+                if self.words[i][1] not in similarID:
+                    similarID.append(self.words[i][1])
+                i += 1
+        return similarID
+
+# word and every string made by deleting up to limit characters from it
+def deletions(word, limit):
+    found = set([word])
+    level = [word]
+    for i in xrange(limit):
+        level = [w[:j] + w[j+1:] for w in level for j in xrange(len(w))]
+        found.update(level)
+    return found
+
+
+# edit distance of word1 and word2, or limit + 1 once it must exceed limit
+def boundedDistance(word1, word2, limit):
     len1 = len(word1)
     len2 = len(word2)
-    # initialization
-    dp = [ [0 for j in xrange(len2 + 1)] for i in xrange(len1 + 1) ]
-    for i in xrange(len1 + 1):
-        dp[i][0] = i
-    for j in xrange(len2 + 1):
-        dp[0][j] = j
+    if abs(len1 - len2) > limit:
+        return limit + 1
+    prev = range(len2 + 1)
     for i in xrange(1, len1 + 1):
+        cur = [i] + [0] * len2
         for j in xrange(1, len2 + 1):
-            dp[i][j] = dp[i-1][j-1] if word1[i-1] == word2[j-1] else min(dp[i-1][j], dp[i][j-1], dp[i-1][j-1]) + 1
-    return dp[len1][len2]
-
-
-# write to file
-def write(scores, index, args):    
-    f = open('.' + args.info)
-    reader = csv.reader(f)
-    outFile = open(args.info, 'wb')
-    writer = csv.writer(outFile, delimiter = ',', quotechar = '"', quoting = csv.QUOTE_MINIMAL)
-    writer.writerow(reader.next())
-    writer.writerow(reader.next())
-    writer.writerow(reader.next())
-
-    for studentData in reader:
-        id = studentData[index['cid']]
-        if len(id) == 0: 
-            continue
-        elif id in scores:
-            studentData[index['score']] = str(scores[id])
-        writer.writerow(studentData)
+            cur[j] = prev[j-1] if word1[i-1] == word2[j-1] else min(prev[j], cur[j-1], prev[j-1]) + 1
+        if min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return min(prev[len2], limit + 1)
+
 
-    f.close()
-    outFile.close()
+# write to file, scores going into column 'score'
+def write(scores, roster, score, args):    
+    roster.write(args.info, {score: scores}, dropBlank=True)
 
 
 # get Input from terminal within range [minV, maxV]
@@ -0,0 +1,137 @@
+import csv
+import marshal
+import os
+import re
+
+# Canvas gradebook CSV shared by grade.py and quiz.py.
+#
+# Columns are found by their header title, falling back to the positions
+# Canvas has always used. Students are stored column by column (one tuple
+# per CSV column) with cid/eid indexes, and the parsed result is cached
+# next to the CSV in a marshal file that is rebuilt whenever the CSV's
+# mtime or size changes.
+
+NAME = 'Student'
+ID = 'ID'
+EID = 'SIS User ID'
+SECTION = 'Section'
+DEFAULTS = {NAME: 0, ID: 1, EID: 2, SECTION: 4}
+
+VERSION = 1     # bump when the cache layout changes
+
+# rosters loaded by this process: path -> ((VERSION, mtime, size), Roster)
+loaded = {}
+
+
+class Roster(object):
+    def __init__(self, head, columns):
+        self.head = head            # title row plus 'Points Possible' etc.
+        self.columns = columns      # one tuple of values per CSV column
+        self.names = columns[self.column(NAME, True, DEFAULTS[NAME])]
+        self.cids = columns[self.column(ID, True, DEFAULTS[ID])]
+        self.eids = columns[self.column(EID, True, DEFAULTS[EID])]
+        self.sections = columns[self.column(SECTION, True, DEFAULTS[SECTION])]
+        self.byCid = dict((cid, i) for i, cid in enumerate(self.cids))
+        self.byEid = dict((eid, i) for i, eid in enumerate(self.eids))
+
+    # Load path, from its cache when the CSV hasn't changed
+    @classmethod
+    def load(cls, path):
+        st = os.stat(path)
+        stamp = (VERSION, st.st_mtime, st.st_size)
+        if path in loaded and loaded[path][0] == stamp:
+            return loaded[path][1]
+        cache = cacheName(path)
+        roster = None
+        try:
+            with open(cache, 'rb') as f:
+                data = marshal.load(f)
+            if data[0] == stamp:
+                roster = cls(data[1], data[2])
+        except (IOError, EOFError, ValueError, TypeError, IndexError):
+            pass
+        if roster is None:
+            roster = cls.parse(path)
+            try:
+                with open(cache + '.tmp', 'wb') as f:
+                    marshal.dump((stamp, roster.head, roster.columns), f)
+                os.rename(cache + '.tmp', cache)
+            except (IOError, OSError):
+                pass    # read-only folder, just parse next time
+        loaded[path] = (stamp, roster)
+        return roster
+
+    @classmethod
+    def parse(cls, path):
+        with open(path, 'rb') as f:
+            rows = list(csv.reader(f))
+        # rows right under the titles without a Canvas ID ('Points
+        # Possible', 'Muted', ...) are part of the header
+        idCol = findColumn(rows[0], ID, True, DEFAULTS[ID])
+        start = 1
+        while start < len(rows) and (idCol >= len(rows[start]) or not rows[start][idCol].strip()):
+            start += 1
+        head = rows[:start]
+        width = max(len(row) for row in rows)
+        students = [row + [''] * (width - len(row)) for row in rows[start:] if row]
+        columns = [tuple(col) for col in zip(*students)] if students else [()] * width
+        return cls(head, columns)
+
+    # index of the first column whose title is (or with exact=False,
+    # contains) title; default if there is none
+    def column(self, title, exact=False, default=None):
+        return findColumn(self.head[0], title, exact, default)
+
+    def __len__(self):
+        return len(self.cids)
+
+    def __contains__(self, cid):
+        return cid in self.byCid
+
+    def name(self, cid):
+        return self.names[self.byCid[cid]]
+
+    def eid(self, cid):
+        return self.eids[self.byCid[cid]]
+
+    def value(self, cid, col):
+        return self.columns[col][self.byCid[cid]]
+
+    # 5 digit unique number of the student's section, 'Unknown' if none
+    def unique(self, cid):
+        mo = re.match(r'([\w\s]*)\(([\d]*)\)', self.sections[self.byCid[cid]])
+        if mo is not None:
+            return mo.group(2)
+        return "Unknown"
+
+    # Write the roster to path with updates {column: {cid: value}} applied.
+    # Rows without a Canvas ID are kept as they are unless dropBlank (quiz.py
+    # has always dropped them, grade.py's export never did). Goes through a
+    # temporary file so a crash leaves the old CSV in place.
+    def write(self, path, updates, dropBlank=False):
+        outFile = open(path + '.tmp', 'wb')
+        writer = csv.writer(outFile, delimiter = ',', quotechar = '"', quoting = csv.QUOTE_MINIMAL)
+        writer.writerows(self.head)
+        changes = [(col, updates[col]) for col in updates]
+        for i, cid in enumerate(self.cids):
+            if len(cid) == 0 and dropBlank:
+                continue
+            row = [column[i] for column in self.columns]
+            for col, values in changes:
+                if cid in values:
+                    row[col] = str(values[cid])
+            writer.writerow(row)
+        outFile.close()
+        os.rename(path + '.tmp', path)
+
+
+def findColumn(titles, title, exact, default):
+    for i in xrange(len(titles)):
+        if titles[i] == title or (not exact and title in titles[i]):
+            return i
+    return default
+
+
+def cacheName(path):
+    folder, name = os.path.split(path)
+    return os.path.join(folder, '.' + name + '.roster')
@@ -0,0 +1,73 @@
+import errno
+import os
+import shutil
+
+# File staging for the turnin -> work -> feedback/graded/compilerr/
+# wrongName/regrade flow, shared by grade.py and quiz.py.
+#
+# Nothing here starts a process. A file that changes folder is renamed,
+# which is atomic and replaces any file of the same name. A file that has
+# to stay where it is is copied, in large blocks (Python 2 has no
+# sendfile/copy_file_range), through a temporary file renamed into place
+# so a crash never leaves half a file behind. Only files nobody writes to
+# may be hard-linked instead: an open(..., 'w') on a link truncates every
+# name of the file.
+
+BLOCK = 1 << 20
+
+
+# Make the folders names under root that don't exist yet, with one listdir
+# of root. Returns their paths in the order given.
+def folders(root, names):
+    existing = set(os.listdir(root)) if os.path.isdir(root) else set()
+    paths = []
+    for name in names:
+        path = os.path.join(root, name)
+        if name not in existing:
+            try:
+                os.makedirs(path)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        paths.append(path)
+    return paths
+
+
+# Copy source to target, through target.<pid>
+def copy(source, target):
+    tmp = '%s.%d' % (target, os.getpid())
+    with open(source, 'rb') as src:
+        with open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst, BLOCK)
+    shutil.copymode(source, tmp)
+    os.rename(tmp, target)
+
+
+# Put source in dirname as name (default its own name) and leave source
+# where it is: a hard link, or a copy on another file system. Returns the
+# new path.
+def place(dirname, source, name=None):
+    target = os.path.join(dirname, name or os.path.basename(source))
+    if os.path.lexists(target):
+        if os.path.exists(target) and os.path.samefile(source, target):
+            return target
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        copy(source, target)
+    return target
+
+
+# Move source into dirname as name (default its own name). Returns the new
+# path.
+def move(dirname, source, name=None):
+    target = os.path.join(dirname, name or os.path.basename(source))
+    try:
+        os.rename(source, target)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        copy(source, target)
+        os.remove(source)
+    return target